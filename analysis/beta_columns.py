@@ -0,0 +1,51 @@
+import numpy as np
+
+
+# The beta distribution fitted for each response is stored as two float columns
+# `<name>_a` (alpha) and `<name>_b` (beta), e.g. `prior_beta_for_kl_a` and `prior_beta_for_kl_b`.
+# Older results files hold a single `<name>` column of (alpha, beta) pairs instead;
+# `split_beta_columns` converts those into the paired layout.
+
+
+def beta_colnames(colname):
+    """
+    :param colname: e.g. "prior_beta_for_kl"
+    :return: names of the alpha and beta columns
+    """
+    return f"{colname}_a", f"{colname}_b"
+
+
+def set_beta_params(df, colname, alpha, beta):
+    """
+    Store the beta parameters for `colname` as two float64 columns.
+    """
+    col_a, col_b = beta_colnames(colname)
+    df[col_a] = np.asarray(alpha, dtype=np.float64)
+    df[col_b] = np.asarray(beta, dtype=np.float64)
+    return df
+
+
+def get_beta_params(df, colname):
+    """
+    :param df:
+    :param colname: e.g. "prior_beta_for_kl"
+    :return: (n, 2) float array with alpha in the first and beta in the second column.
+    Falls back to an old-style column of (alpha, beta) pairs if there are no paired columns.
+    """
+    col_a, col_b = beta_colnames(colname)
+    if col_a in df.columns and col_b in df.columns:
+        return np.column_stack([df[col_a].to_numpy(dtype=np.float64), df[col_b].to_numpy(dtype=np.float64)])
+    return np.array(df[colname].tolist(), dtype=np.float64).reshape(len(df), 2)
+
+
+def split_beta_columns(df):
+    """
+    Compatibility reader for results files written with (alpha, beta) pair columns:
+    replace every such `*_beta_for_*` column by its `_a`/`_b` float columns.
+    """
+    for colname in df.columns:
+        if "beta_for" in colname and df[colname].dtype == object:
+            params = get_beta_params(df, colname)
+            df = df.drop(columns=[colname])
+            df = set_beta_params(df, colname, params[:, 0], params[:, 1])
+    return df
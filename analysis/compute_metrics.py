@@ -3,6 +3,8 @@ import pandas as pd
 import argparse
 from scipy.stats import entropy
 from metrics import *
+from frame_io import read_frame, write_frame
+from beta_columns import get_beta_params, split_beta_columns
 from ast import literal_eval
 
 
@@ -10,35 +12,60 @@ from ast import literal_eval
 # Reshape dataframe and compute metrics: KL Utility, ER, and Bayes Factor
 
 
-def compute_metrics(raw_data, prior_colname, posterior_colname, joint="separate"):
+def compute_metrics(raw_data, prior_colname, posterior_colname, joint="separate", report_entropy_fallback=False):
     """
     :param raw_data:
     :param prior_colname:
     :param posterior_colname:
     :param joint: whether beta distributions were optimized 'separate' for each metric, 'joint', or 'both'
+    :param report_entropy_fallback: print how many rows of the beta entropy metrics used to get the -5 fallback value
     :return:
     """
     items = raw_data
-    items['first_order_belief_change'] = items.apply(lambda x: prior_posterior_distance(x[posterior_colname], x[prior_colname]), axis=1)
-    items['second_order_belief_change'] = items.apply(lambda x: prior_posterior_distance(x['prior_confidence'], x['posterior_confidence']), axis=1)
-    items['entropy_change'] = items.apply(lambda x: entropy_reduction(x[prior_colname], x[posterior_colname]), axis=1)
-    items['kl_utility'] = items.apply(lambda x: kl_util(x[posterior_colname], x[prior_colname]), axis=1)
-    items['kl'] = items.apply(lambda x: kl(x[posterior_colname], x[prior_colname]), axis=1)
-    items['bayes_factor_utility'] = items.apply(lambda x: bf_utility_polar(x[posterior_colname], x[prior_colname]), axis=1)
+    # Pull every input out once as a contiguous array, compute all metrics on whole columns, then write them back
+    prior = items[prior_colname].to_numpy(dtype=np.float64)
+    posterior = items[posterior_colname].to_numpy(dtype=np.float64)
+    prior_confidence = items['prior_confidence'].to_numpy()
+    posterior_confidence = items['posterior_confidence'].to_numpy()
+
+    columns = {
+        'first_order_belief_change': prior_posterior_distance_vec(posterior, prior),
+        'second_order_belief_change': prior_posterior_distance_vec(prior_confidence, posterior_confidence),
+        'entropy_change': entropy_reduction_vec(prior, posterior),
+        'kl_utility': kl_util_vec(posterior, prior),
+        'kl': kl_vec(posterior, prior),
+        'bayes_factor_utility': bf_utility_polar_vec(posterior, prior),
+    }
     if joint in ["separate", "both"]:
-        items['beta_kl_utility'] = items.apply(lambda x: kl_util_dirichlet(x['posterior_beta_for_kl'], x['prior_beta_for_kl']), axis=1)
-        items['beta_kl'] = items.apply(lambda x: kl_dirichlet(x['posterior_beta_for_kl'], x['prior_beta_for_kl']), axis=1)
-        items['beta_entropy_change'] = items.apply(lambda x: entropy_reduction_dirichlet(x['prior_beta_for_beta_entropy_change'], x['posterior_beta_for_beta_entropy_change']), axis=1)
-        # items['beta_bayes_factor_utility'] = items.apply(lambda x: beta_bayes_factor_util(x['prior_beta_for_bf'], x['posterior_beta_for_bf']), axis=1)
-        items['beta_bayes_factor_utility_1'] = items.apply(lambda x: beta_bayes_factor_util_1(x['prior_beta_for_beta_bayes_factor_utility_1'], x['posterior_beta_for_beta_bayes_factor_utility_1']), axis=1)
-        items['pure_second_order_belief_change'] = items.apply(lambda x: pure_second_order_belief_change(x['prior_beta_for_pure_second_order_belief_change'], x['posterior_beta_for_pure_second_order_belief_change']), axis=1)
+        prior_kl, posterior_kl = get_beta_params(items, 'prior_beta_for_kl'), get_beta_params(items, 'posterior_beta_for_kl')
+        columns['beta_kl_utility'] = kl_util_dirichlet_vec(posterior_kl, prior_kl)
+        columns['beta_kl'] = kl_dirichlet_vec(posterior_kl, prior_kl)
+        columns['beta_entropy_change'] = entropy_reduction_dirichlet_vec(get_beta_params(items, 'prior_beta_for_beta_entropy_change'),
+                                                                         get_beta_params(items, 'posterior_beta_for_beta_entropy_change'))
+        # columns['beta_bayes_factor_utility'] = beta_bayes_factor_util_vec(get_beta_params(items, 'prior_beta_for_bf'), get_beta_params(items, 'posterior_beta_for_bf'))
+        columns['beta_bayes_factor_utility_1'] = beta_bayes_factor_util_1_vec(get_beta_params(items, 'prior_beta_for_beta_bayes_factor_utility_1'),
+                                                                              get_beta_params(items, 'posterior_beta_for_beta_bayes_factor_utility_1'))
+        columns['pure_second_order_belief_change'] = pure_second_order_belief_change_vec(get_beta_params(items, 'prior_beta_for_pure_second_order_belief_change'),
+                                                                                         get_beta_params(items, 'posterior_beta_for_pure_second_order_belief_change'))
     if joint in ["joint", "both"]:
-        items['beta_kl_utility_joint'] = items.apply(lambda x: kl_util_dirichlet(x['posterior_beta_for_joint'], x['prior_beta_for_joint']), axis=1)
-        items['beta_kl_joint'] = items.apply(lambda x: kl_dirichlet(x['posterior_beta_for_joint'], x['prior_beta_for_joint']), axis=1)
-        items['beta_entropy_change_joint'] = items.apply(lambda x: entropy_reduction_dirichlet(x['prior_beta_for_joint'], x['posterior_beta_for_joint']), axis=1)
-        # items['beta_bayes_factor_utility_joint'] = items.apply(lambda x: beta_bayes_factor_util(x['prior_beta_for_joint'], x['posterior_beta_for_joint']), axis=1)
-        items['beta_bayes_factor_utility_1_joint'] = items.apply(lambda x: beta_bayes_factor_util_1(x['prior_beta_for_joint'], x['posterior_beta_for_joint']), axis=1)
-        items['pure_second_order_belief_change_joint'] = items.apply(lambda x: pure_second_order_belief_change(x['prior_beta_for_joint'], x['posterior_beta_for_joint']), axis=1)
+        prior_joint, posterior_joint = get_beta_params(items, 'prior_beta_for_joint'), get_beta_params(items, 'posterior_beta_for_joint')
+        columns['beta_kl_utility_joint'] = kl_util_dirichlet_vec(posterior_joint, prior_joint)
+        columns['beta_kl_joint'] = kl_dirichlet_vec(posterior_joint, prior_joint)
+        columns['beta_entropy_change_joint'] = entropy_reduction_dirichlet_vec(prior_joint, posterior_joint)
+        # columns['beta_bayes_factor_utility_joint'] = beta_bayes_factor_util_vec(prior_joint, posterior_joint)
+        columns['beta_bayes_factor_utility_1_joint'] = beta_bayes_factor_util_1_vec(prior_joint, posterior_joint)
+        columns['pure_second_order_belief_change_joint'] = pure_second_order_belief_change_vec(prior_joint, posterior_joint)
+
+    if report_entropy_fallback:
+        for colname, suffix in [('beta_entropy_change', '_for_beta_entropy_change'), ('beta_entropy_change_joint', '_for_joint')]:
+            if colname not in columns:
+                continue
+            fallback = entropy_dirichlet_fallback_rows(get_beta_params(items, 'prior_beta' + suffix)) | \
+                entropy_dirichlet_fallback_rows(get_beta_params(items, 'posterior_beta' + suffix))
+            print(f"{colname}: {fallback.sum()} of {len(fallback)} rows previously got the -5 entropy fallback")
+
+    for colname, values in columns.items():
+        items[colname] = values
     return items
 
 def scale_metrics(df, df_params, joint="separate"):
@@ -114,17 +141,20 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--input", help="Relative path to a (widened) .jsonl file containing one set of participant-vignette responses per row")
     parser.add_argument("--params", help="Relative path to a .csv file with optimized parameters")
-    parser.add_argument("--output", help="Name of output file")
+    parser.add_argument("--output", help="Name of output file (.parquet, .arrow, .csv or .jsonl)")
     parser.add_argument("--scale", action="store_true", help="Whether to scale all metrics to fall in [0,1].")
     parser.add_argument("--joint", default="separate", help="Whether beta params are optimized 'separate' for each metric, 'joint', or 'both'.")
     parser.add_argument("--obj", default="pearson", help="Select the optimization objective. Options: pearson, mse, std, centrality, pearson_reg")
+    parser.add_argument("--report_entropy_fallback", action="store_true", help="Print how many rows of the beta entropy metrics used to get the -5 fallback value of older versions.")
 
 
     args = parser.parse_args()
     # Read filtered data from csv
-    df = pd.read_json(args.input, orient="records", lines=True)
+    df = read_frame(args.input)
+    df = split_beta_columns(df)
     # Compute predictor metrics
-    df = compute_metrics(df, prior_colname='prior_sliderResponse', posterior_colname='posterior_sliderResponse', joint=args.joint)
+    df = compute_metrics(df, prior_colname='prior_sliderResponse', posterior_colname='posterior_sliderResponse', joint=args.joint,
+                         report_entropy_fallback=args.report_entropy_fallback)
 
     if args.scale:
         df_params = pd.read_csv(args.params, index_col=0)
@@ -132,4 +162,4 @@ if __name__ == "__main__":
         df = scale_metrics(df, df_params, joint=args.joint)
 
     # Get outfile
-    df.to_json(args.output, orient="records", lines=True)
\ No newline at end of file
+    write_frame(df, args.output)
\ No newline at end of file
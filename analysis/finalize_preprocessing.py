@@ -1,7 +1,19 @@
 import pandas as pd
 import argparse
+from frame_io import read_frame, write_frame
+from beta_columns import split_beta_columns
 
 
+def finalize(df):
+    """
+    :param df: results with all beta params and metrics computed
+    :return: df with the beta params as `_a`/`_b` columns after all other columns
+    """
+    # Beta params are already stored as `_a`/`_b` columns; only files written by older versions of the fitting scripts need splitting
+    df = split_beta_columns(df)
+    # Keep the beta params after the metrics, as in earlier versions of this file
+    beta_columns = [c for c in df.columns if "beta_for" in c]
+    return df[[c for c in df.columns if c not in beta_columns] + beta_columns]
 
 
 if __name__ == "__main__":
@@ -9,19 +21,15 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--input",
                         help="Relative path to a .json file containing the (partly) preprocessed data with all beta-values and metrics computed, and participant quality checks")
-    parser.add_argument("--output", default=None, help="Name of output file")
+    parser.add_argument("--output", default=None, help="Name of output file (.csv by default; .parquet, .arrow or .jsonl also work)")
     args = parser.parse_args()
 
     # Read filtered data from csv
-    df = pd.read_json(args.input, orient="records", lines=True)
+    df = read_frame(args.input)
+    df = finalize(df)
 
-    # Widen dataframe
-    for column_name in df.columns:
-        if "beta_for" in column_name:
-            df[f"{column_name}_a"] = df[column_name].apply(lambda x: x[0])
-            df[f"{column_name}_b"] = df[column_name].apply(lambda x: x[1])
-            df = df.drop(columns=[column_name])
-
-    # Get outfile
-    output = args.output if args.output else args.input
-    df.to_csv(output)
+    # Get outfile (without --output, the input file is overwritten with the csv export)
+    if args.output:
+        write_frame(df, args.output, index=True)
+    else:
+        df.to_csv(args.input)
@@ -6,6 +6,9 @@ import random
 import numpy as np
 from scipy.optimize import minimize
 from metrics import *
+from frame_io import read_frame, write_frame
+from beta_columns import set_beta_params
+from fit_beta_and_g import FIT_COLUMNS, prepare_fit_data, beta_params_for_fit, metric_jac_for_fit, loss, loss_grad
 import math
 import argparse
 
@@ -24,86 +27,77 @@ def certainty_linking_function(x, certainty):
 
 
 def objective_function_exp_concentration_map(x, df, metric, obj="pearson"):
-    def map_certainty_to_concentration_local(certainty):
-        return certainty_linking_function(x, certainty)
-
-    # for field in ["prior", "posterior"]:
-    prior = df.apply(lambda z: fit_beta_mode_concentration(z[f"prior_sliderResponse"],
-                                                                map_certainty_to_concentration_local(z[f"prior_confidence"])), axis=1)
-    posterior = df.apply(lambda z: fit_beta_mode_concentration(z[f"posterior_sliderResponse"],
-                                                                map_certainty_to_concentration_local(z[f"posterior_confidence"])), axis=1)
-
-    r = [metric(pre, post) for pre, post in zip(prior, posterior)]
-    try:
-        if obj == "pearson":
-            to_return = -pearsonr(df["relevance_sliderResponse"], r)[0]
-        elif obj == "mse":
-            to_return = np.mean([(rel - score)**2 for rel, score in zip(df["relevance_sliderResponse"], r)])
-        elif obj == "std":
-            to_return = -np.std(r)
-        elif obj == "centrality":
-            to_return = (0.5 - np.mean(r))**2
-        elif obj == "pearson_reg":
-            p = 0.5
-            to_return = p * -pearsonr(df["relevance_sliderResponse"], r)[0] + \
-                        (1-p) * -np.std(r)
-    except ValueError:
-        to_return = np.inf
-    # print(x, to_return)
-    return to_return
+    data = prepare_fit_data(df)
+    prior = beta_params_for_fit(x, data, "prior")
+    posterior = beta_params_for_fit(x, data, "posterior")
+    r = metric(prior, posterior)
+    return loss(data["relevance_sliderResponse"], r, obj=obj)
 
 def objective_function_exp_concentration_map_all_metrics(x, df, metrics, return_metric_vals=False, obj="pearson"):
-    def map_certainty_to_concentration_local(certainty):
-        return certainty_linking_function(x, certainty)
-
-    # for field in ["prior", "posterior"]:
-    prior = df.apply(lambda z: fit_beta_mode_concentration(z[f"prior_sliderResponse"],
-                                                                map_certainty_to_concentration_local(z[f"prior_confidence"])), axis=1)
-    posterior = df.apply(lambda z: fit_beta_mode_concentration(z[f"posterior_sliderResponse"],
-                                                                map_certainty_to_concentration_local(z[f"posterior_confidence"])), axis=1)
+    data = prepare_fit_data(df)
+    prior = beta_params_for_fit(x, data, "prior")
+    posterior = beta_params_for_fit(x, data, "posterior")
     rs = []
     for metric in metrics:
-        r = [metrics[metric](pre, post) for pre, post in zip(prior, posterior)]
-        try:
-            if obj == "pearson":
-                to_return = -pearsonr(df["relevance_sliderResponse"], r)[0]
-            elif obj == "mse":
-                to_return = np.mean([(rel - score)**2 for rel, score in zip(df["relevance_sliderResponse"], r)])
-            elif obj == "std":
-                to_return = -np.std(r)
-            elif obj == "centrality":
-                to_return = (0.5 - np.mean(r))**2
-            elif obj == "pearson_reg":
-                p = 0.5
-                to_return = p * -pearsonr(df["relevance_sliderResponse"], r)[0] + \
-                            (1-p) * -np.std(r)
-        except ValueError:
-            to_return = np.inf
-        rs.append(to_return)
+        r = metrics[metric](prior, posterior)
+        rs.append(loss(data["relevance_sliderResponse"], r, obj=obj))
     if return_metric_vals:
         return sum(rs)/len(rs), rs
     else:
         return sum(rs)/len(rs)
 
+def objective_and_grad_exp_concentration_map(x, df, metric, metric_grad, obj="pearson"):
+    """
+    Same as objective_function_exp_concentration_map, but also returns the exact gradient w.r.t. x.
+    """
+    data = prepare_fit_data(df)
+    prior = beta_params_for_fit(x, data, "prior")
+    posterior = beta_params_for_fit(x, data, "posterior")
+    r = metric(prior, posterior)
+    d_loss_d_r = loss_grad(data["relevance_sliderResponse"], r, obj=obj)
+    return loss(data["relevance_sliderResponse"], r, obj=obj), d_loss_d_r @ metric_jac_for_fit(x, data, prior, posterior, metric_grad)
+
+def objective_and_grad_exp_concentration_map_all_metrics(x, df, metrics, metric_grads, obj="pearson"):
+    """
+    Same as objective_function_exp_concentration_map_all_metrics, but also returns the exact gradient w.r.t. x.
+    """
+    data = prepare_fit_data(df)
+    losses, jacs = [], []
+    for metric in metrics:
+        l, j = objective_and_grad_exp_concentration_map(x, data, metrics[metric], metric_grads[metric], obj=obj)
+        losses.append(l)
+        jacs.append(j)
+    return sum(losses)/len(losses), sum(jacs)/len(jacs)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--training", help="Path to results file with `training data` for fitting beta parameters (this is probably round 1 data)")
     parser.add_argument("--input", help="Path to results file with actual official results")
-    parser.add_argument("--output", default=None)
+    parser.add_argument("--output", default=None, help="Name of output file (.parquet, .arrow, .csv or .jsonl)")
     parser.add_argument("--optimize_joint", default="separate", help="Whether to optimize each metric separately ('separate'), jointly ('joint'), or both ('both')")
     parser.add_argument("--obj", default="pearson", help="Select the optimization objective. Options: pearson, mse, std, centrality, pearson_reg")
+    parser.add_argument("--analytic_grad", action="store_true", help="Give the optimizer exact gradients instead of estimating them by finite differences.")
     args = parser.parse_args()
 
-    df_train = pd.read_json(args.training, orient="records", lines=True)
+    df_train = read_frame(args.training, columns=FIT_COLUMNS)
     print(args.input)
-    df = pd.read_json(args.input, orient="records", lines=True)
+    df = read_frame(args.input)
+    # Extract the training arrays once; every objective evaluation below reuses them
+    train_data = prepare_fit_data(df_train)
     metrics = {
-        "kl_util": lambda p, q: kl_util_dirichlet(q, p),
-        "kl": lambda p, q: kl_dirichlet(q, p),
-        "entropy": entropy_reduction_dirichlet,
-        "bf": beta_bayes_factor_util,
-        "2nd_order_change": pure_second_order_belief_change
+        "kl_util": lambda p, q: kl_util_dirichlet_vec(q, p),
+        "kl": lambda p, q: kl_dirichlet_vec(q, p),
+        "entropy": entropy_reduction_dirichlet_vec,
+        "bf": beta_bayes_factor_util_vec,
+        "2nd_order_change": pure_second_order_belief_change_vec
+    }
+    metric_grads = {
+        "kl_util": lambda p, q: kl_util_dirichlet_vec_grad(q, p)[::-1],
+        "kl": lambda p, q: kl_dirichlet_vec_grad(q, p)[::-1],
+        "entropy": entropy_reduction_dirichlet_vec_grad,
+        "bf": beta_bayes_factor_util_vec_grad,
+        "2nd_order_change": pure_second_order_belief_change_vec_grad
     }
 
     # Do optimization for each metric separately, find optimal params x
@@ -113,26 +107,32 @@ if __name__ == "__main__":
             if args.optimize_joint not in ["separate", "both"]:
                 continue
             print(metric)
-            x = minimize(lambda x: objective_function_exp_concentration_map(x, df_train, metrics[metric], obj=args.obj),
+            x = minimize(lambda x: objective_function_exp_concentration_map(x, train_data, metrics[metric], obj=args.obj)
+                         if not args.analytic_grad else
+                         objective_and_grad_exp_concentration_map(x, train_data, metrics[metric], metric_grads[metric], obj=args.obj),
                          method='SLSQP',
+                         jac=args.analytic_grad,
                          x0=np.array([1, 2]),
                          bounds=[(0, np.inf), (1, np.inf)]
                          ).x
             params[metric] = x
             print(f"{x[0]} * {x[1]}^c")
-            print(f"best loss: {objective_function_exp_concentration_map(x, df_train, metrics[metric], obj=args.obj)}")
+            print(f"best loss: {objective_function_exp_concentration_map(x, train_data, metrics[metric], obj=args.obj)}")
             print()
 
     if args.optimize_joint in ["joint", "both"]:
         print("Joint")
-        x = minimize(lambda x: objective_function_exp_concentration_map_all_metrics(x, df_train, metrics, obj=args.obj),
+        x = minimize(lambda x: objective_function_exp_concentration_map_all_metrics(x, train_data, metrics, obj=args.obj)
+                     if not args.analytic_grad else
+                     objective_and_grad_exp_concentration_map_all_metrics(x, train_data, metrics, metric_grads, obj=args.obj),
                      method='SLSQP',
+                     jac=args.analytic_grad,
                      x0=np.array([1,2]),
                      bounds=[(0, np.inf), (1, np.inf)]
                      ).x
         params["joint"] = x
         print(f"{x[0]} * {x[1]}^c")
-        vals = objective_function_exp_concentration_map_all_metrics(x, df_train, metrics, return_metric_vals=True, obj=args.obj)
+        vals = objective_function_exp_concentration_map_all_metrics(x, train_data, metrics, return_metric_vals=True, obj=args.obj)
         print(f"best avg correlation: {-1 * vals[0]}")
         print(f"per metric: {str({k:v for k,v in zip(metrics.keys(), vals)})}")
 
@@ -141,15 +141,15 @@ if __name__ == "__main__":
         results = []
         for metric in params:
             for p in ["prior", "posterior"]:
-                df[f"{p}_concentration"] = df[f"{p}_confidence"].apply(lambda c: certainty_linking_function(params[metric], c))
-                df[f"{p}_beta_for_{metric}"] = df.apply(lambda row: fit_beta_mode_concentration(row[f"{p}_sliderResponse"], row[f"{p}_concentration"]), axis=1)
-                df = df.drop(f"{p}_concentration", axis=1)
+                concentration = certainty_linking_function(params[metric], df[f"{p}_confidence"].to_numpy(dtype=np.float64))
+                a, b = fit_beta_mode_concentration(df[f"{p}_sliderResponse"].to_numpy(dtype=np.float64), concentration)
+                df = set_beta_params(df, f"{p}_beta_for_{metric}", a, b)
 
             def objective(metric, obj):
                 if metric == "joint":
-                    return objective_function_exp_concentration_map_all_metrics(x, df_train, metrics, obj=obj)
+                    return objective_function_exp_concentration_map_all_metrics(x, train_data, metrics, obj=obj)
                 else:
-                    return objective_function_exp_concentration_map(x, df_train, metrics[metric], obj=obj)
+                    return objective_function_exp_concentration_map(x, train_data, metrics[metric], obj=obj)
             results.append({
                 "metric": metric,
                 "x": params[metric],
@@ -162,28 +162,16 @@ if __name__ == "__main__":
 
         results = pd.DataFrame(results)
         results.to_csv(args.output + "_optimization_results.csv")
-        df.to_json(args.output, orient="records", lines=True)
+        write_frame(df, args.output)
 
     # Run a grid search and save heatmaps
     if args.optimize_joint == "grid":
-        # First run the grid search
+        # First run the grid search, evaluating the whole grid at once
+        from grid_search import run_grid_search
         values = np.linspace(1.01, 5, 12)
         X, Y = np.meshgrid(values, values)
-        coordinates_np = np.dstack((X, Y))
-        # zeros = np.zeros_like(coordinates_np)
-        rows = []
-        for i, _ in enumerate(coordinates_np):
-            for j, x in enumerate(coordinates_np[i]):
-                vals = objective_function_exp_concentration_map_all_metrics(x, df_train, metrics, return_metric_vals=True, obj=args.obj)
-                row = {
-                    "a": x[0],
-                    "b": x[1],
-                    "avg": vals[0]
-                }
-                for i, metric in enumerate(metrics):
-                    row[metric] = vals[1][i]
-                rows.append(row)
-        df = pd.DataFrame(rows)
+        grid = np.column_stack([X.ravel(), Y.ravel()])
+        df = run_grid_search(grid, train_data, obj=args.obj, chunk_size=len(grid), metrics=metrics)
         df = df.set_index(["a", "b"])
         print(df.sort_values("avg"))
 
@@ -1,13 +1,18 @@
 import re
 import pandas as pd
-from scipy.stats import beta, entropy, pearsonr
+from scipy.stats import beta, entropy, pearsonr, qmc
 from scipy.special import loggamma, digamma, gamma
 import random
 import numpy as np
 from scipy.optimize import minimize
 from metrics import *
+from frame_io import read_frame, write_frame
+from beta_columns import set_beta_params
 import math
 import argparse
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 def fit_beta_mode_concentration(mode, concentration):
     """
@@ -23,73 +28,149 @@ def certainty_linking_function(x, certainty):
     return x[0] * (x[1] ** certainty)
 
 
-def objective_function_exp_concentration_map(x, df, metric, first_order=False, obj="pearson"):
-    def map_certainty_to_concentration_local(certainty):
-        return certainty_linking_function(x, certainty)
+metrics_so = {
+    "beta_kl": lambda p, q: kl_dirichlet_vec(q, p),
+    "beta_entropy_change": entropy_reduction_dirichlet_vec,
+    "beta_bayes_factor_utility_1": beta_bayes_factor_util_1_vec,
+    "pure_second_order_belief_change": pure_second_order_belief_change_vec,
+}
+metrics_fo = {
+    "kl": lambda p, q: kl_vec(q, p),
+    "entropy_change": entropy_reduction_vec,
+}
+all_metrics = metrics_so | metrics_fo
+# Derivatives of the second order metrics w.r.t. their prior and posterior beta params (same argument order as above)
+metric_grads_so = {
+    "beta_kl": lambda p, q: kl_dirichlet_vec_grad(q, p)[::-1],
+    "beta_entropy_change": entropy_reduction_dirichlet_vec_grad,
+    "beta_bayes_factor_utility_1": beta_bayes_factor_util_1_vec_grad,
+    "pure_second_order_belief_change": pure_second_order_belief_change_vec_grad,
+}
 
-    # for field in ["prior", "posterior"]:
-    if not first_order:
-        prior = df.apply(lambda z: fit_beta_mode_concentration(z[f"prior_sliderResponse"],
-                                                                    map_certainty_to_concentration_local(z[f"prior_confidence"])), axis=1)
-        posterior = df.apply(lambda z: fit_beta_mode_concentration(z[f"posterior_sliderResponse"],
-                                                                    map_certainty_to_concentration_local(z[f"posterior_confidence"])), axis=1)
-    else:
-        prior = df[f"prior_sliderResponse"]
-        posterior = df[f"posterior_sliderResponse"]
+FIT_COLUMNS = [
+    "prior_sliderResponse",
+    "posterior_sliderResponse",
+    "prior_confidence",
+    "posterior_confidence",
+    "relevance_sliderResponse",
+]
 
 
-    r = [g(metric(pre, post), x[2]) for pre, post in zip(prior, posterior)]
+def prepare_fit_data(df):
+    """
+    Pull the columns used by the objective functions out of the dataframe once per fit,
+    so that each evaluation of the objective only does array arithmetic.
+    :param df: widened results dataframe (or the output of a previous call to prepare_fit_data)
+    :return: dict mapping column name to float array
+    """
+    if isinstance(df, dict):
+        return df
+    return {col: df[col].to_numpy(dtype=np.float64) for col in FIT_COLUMNS}
+
+
+def beta_params_for_fit(x, data, field):
+    """
+    :return: (n, 2) array of beta params for `field` ('prior' or 'posterior') under linking function params x
+    """
+    concentration = certainty_linking_function(x, data[f"{field}_confidence"])
+    return np.column_stack(fit_beta_mode_concentration(data[f"{field}_sliderResponse"], concentration))
+
+
+def metric_jac_for_fit(x, data, prior, posterior, metric_grad):
+    """
+    Chain rule through fit_beta_mode_concentration and certainty_linking_function.
+    :param metric_grad: returns the derivatives of the metric w.r.t. the prior and the posterior beta params
+    :return: (n, 2) array with the derivatives of the metric w.r.t. the linking function params a and b
+    """
+    jac = np.zeros((len(prior), 2))
+    for field, d_params in zip(["prior", "posterior"], metric_grad(prior, posterior)):
+        mode = data[f"{field}_sliderResponse"]
+        certainty = data[f"{field}_confidence"]
+        # alpha = mode * (concentration-2) + 1, beta = (1-mode) * (concentration-2) + 1
+        d_concentration = d_params[:, 0] * mode + d_params[:, 1] * (1 - mode)
+        jac[:, 0] += d_concentration * x[1] ** certainty
+        jac[:, 1] += d_concentration * x[0] * certainty * x[1] ** (certainty - 1)
+    return jac
+
+
+def loss(relevance, r, obj="pearson"):
     try:
         if obj == "pearson":
-            to_return = -pearsonr(df["relevance_sliderResponse"], r)[0]
+            to_return = -pearsonr(relevance, r)[0]
         elif obj == "mse":
-            to_return = np.mean([(rel - score)**2 for rel, score in zip(df["relevance_sliderResponse"], r)])
+            to_return = np.mean((relevance - r)**2)
         elif obj == "std":
             to_return = -np.std(r)
         elif obj == "centrality":
             to_return = (0.5 - np.mean(r))**2
         elif obj == "pearson_reg":
             p = 0.5
-            to_return = p * -pearsonr(df["relevance_sliderResponse"], r)[0] + \
+            to_return = p * -pearsonr(relevance, r)[0] + \
                         (1-p) * -np.std(r)
     except ValueError:
         to_return = np.inf
     return to_return
 
+
+def loss_grad(relevance, r, obj="pearson"):
+    """
+    :return: derivative of loss(relevance, r, obj) w.r.t. each element of r
+    """
+    n = len(r)
+    r_centered = r - np.mean(r)
+    s_rr = np.sum(r_centered**2)
+    d_pearson = d_std = 0
+    if obj in ["pearson", "pearson_reg"]:
+        y_centered = relevance - np.mean(relevance)
+        norm = np.sqrt(np.sum(y_centered**2) * s_rr)
+        corr = np.sum(y_centered * r_centered) / norm
+        d_pearson = -(y_centered / norm - corr * r_centered / s_rr)
+    if obj in ["std", "pearson_reg"]:
+        d_std = -r_centered / (n * np.sqrt(s_rr / n))
+    if obj == "pearson":
+        return d_pearson
+    elif obj == "mse":
+        return -2 * (relevance - r) / n
+    elif obj == "std":
+        return d_std
+    elif obj == "centrality":
+        return np.full(n, -2 * (0.5 - np.mean(r)) / n)
+    elif obj == "pearson_reg":
+        p = 0.5
+        return p * d_pearson + (1-p) * d_std
+
+
+def objective_function_exp_concentration_map(x, df, metric, first_order=False, obj="pearson"):
+    """
+    :param x: linking function params (a, b) and scaling param g
+    :param df: dataframe, or the arrays returned by prepare_fit_data (much faster when called repeatedly)
+    :param metric: vectorized metric taking prior and posterior arrays
+    """
+    data = prepare_fit_data(df)
+    if not first_order:
+        prior = beta_params_for_fit(x, data, "prior")
+        posterior = beta_params_for_fit(x, data, "posterior")
+    else:
+        prior = data["prior_sliderResponse"]
+        posterior = data["posterior_sliderResponse"]
+
+    r = g(metric(prior, posterior), x[2])
+    return loss(data["relevance_sliderResponse"], r, obj=obj)
+
 def objective_function_exp_concentration_map_all_metrics(x, df, first_order=False, return_metric_vals=False, return_judgments=False, obj="pearson"):
-    def map_certainty_to_concentration_local(certainty):
-        return certainty_linking_function(x, certainty)
-
-    # for field in ["prior", "posterior"]:
-    prior = df.apply(lambda z: fit_beta_mode_concentration(z[f"prior_sliderResponse"],
-                                                                map_certainty_to_concentration_local(z[f"prior_confidence"])), axis=1)
-    posterior = df.apply(lambda z: fit_beta_mode_concentration(z[f"posterior_sliderResponse"],
-                                                                map_certainty_to_concentration_local(z[f"posterior_confidence"])), axis=1)
+    data = prepare_fit_data(df)
+    prior = beta_params_for_fit(x, data, "prior")
+    posterior = beta_params_for_fit(x, data, "posterior")
     if first_order:
-        prior_fo = df[f"prior_sliderResponse"]
-        posterior_fo = df[f"posterior_sliderResponse"]
+        prior_fo = data["prior_sliderResponse"]
+        posterior_fo = data["posterior_sliderResponse"]
 
     def compute_losses(metric, metric_is_first_order=False):
         if not metric_is_first_order:
-            r = [g(all_metrics[metric](pre, post), x[2]) for pre, post in zip(prior, posterior)]
+            r = g(all_metrics[metric](prior, posterior), x[2])
         else:
-            r = [g(all_metrics[metric](pre, post), x[2]) for pre, post in zip(prior_fo, posterior_fo)]
-        try:
-            if obj == "pearson":
-                to_return = -pearsonr(df["relevance_sliderResponse"], r)[0]
-            elif obj == "mse":
-                to_return = np.mean([(rel - score)**2 for rel, score in zip(df["relevance_sliderResponse"], r)])
-            elif obj == "std":
-                to_return = -np.std(r)
-            elif obj == "centrality":
-                to_return = (0.5 - np.mean(r))**2
-            elif obj == "pearson_reg":
-                p = 0.5
-                to_return = p * -pearsonr(df["relevance_sliderResponse"], r)[0] + \
-                            (1-p) * -np.std(r)
-        except ValueError:
-            to_return = np.inf
-        return to_return, r
+            r = g(all_metrics[metric](prior_fo, posterior_fo), x[2])
+        return loss(data["relevance_sliderResponse"], r, obj=obj), r
 
     rs = []
     judgments = []
@@ -114,175 +195,435 @@ def objective_function_exp_concentration_map_all_metrics(x, df, first_order=Fals
         return tuple(to_return)
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--training", help="Path to results file with `training data` for fitting beta parameters (this is probably round 1 data)")
-    parser.add_argument("--input", help="Path to results file with actual official results")
-    parser.add_argument("--output", default=None)
-    parser.add_argument("--optimize_joint", default="separate", help="Whether to optimize each metric separately ('separate'), jointly ('joint'), or both ('both')")
-    parser.add_argument("--first_order", action="store_true", help="Whether to include first order metrics.")
-    parser.add_argument("--obj", default="pearson", help="Select the optimization objective. Options: pearson, mse, std, centrality, pearson_reg")
-    args = parser.parse_args()
+def objective_and_grad_exp_concentration_map(x, df, metric, metric_grad=None, first_order=False, obj="pearson"):
+    """
+    Same as objective_function_exp_concentration_map, but also returns the exact gradient w.r.t. x
+    (for use with `minimize(..., jac=True)`).
+    :param metric_grad: derivatives of the metric w.r.t. prior and posterior beta params (not needed if first_order)
+    """
+    data = prepare_fit_data(df)
+    if not first_order:
+        prior = beta_params_for_fit(x, data, "prior")
+        posterior = beta_params_for_fit(x, data, "posterior")
+    else:
+        prior = data["prior_sliderResponse"]
+        posterior = data["posterior_sliderResponse"]
 
-    df_train = pd.read_json(args.training, orient="records", lines=True)
-    print(args.input)
-    df = pd.read_json(args.input, orient="records", lines=True)
-    metrics_so = {
-        "beta_kl": lambda p, q: kl_dirichlet(q, p),
-        "beta_entropy_change": entropy_reduction_dirichlet,
-        "beta_bayes_factor_utility_1": beta_bayes_factor_util_1,
-        "pure_second_order_belief_change": pure_second_order_belief_change,
-    }
-    metrics_fo = {
-        "kl": lambda p, q: kl(q, p),
-        "entropy_change": entropy_reduction,
-    }
-    all_metrics = metrics_so | metrics_fo
-    
-    A_INIT = 2
-    B_INIT = 2
-    G_INIT = 2
-    # G_INIT = math.e
-    
-    A_BOUNDS = (1, np.inf)
-    B_BOUNDS = (1, np.inf)
-    G_BOUNDS = (1, np.inf)
-    # G_BOUNDS = (math.e, math.e)
-
-
-    # Do optimization for each metric separately, find optimal params x
-    params = {}
-    if args.optimize_joint in ["separate", "both"]:
-        for metric in metrics_so:
-            if args.optimize_joint not in ["separate", "both"]:
-                continue
-            print(metric)
-            x = minimize(lambda x: objective_function_exp_concentration_map(x, df_train, metrics_so[metric], obj=args.obj),
-                         # method='TNC',
-                         method='SLSQP',
-                         x0=np.array([A_INIT, B_INIT, G_INIT]),
-                         bounds=[A_BOUNDS, B_BOUNDS, G_BOUNDS]
-                         ).x
-            params[metric] = x
+    m = metric(prior, posterior)
+    r = g(m, x[2])
+    d_r_d_m, d_r_d_g = g_grad(m, x[2])
+    d_loss_d_r = loss_grad(data["relevance_sliderResponse"], r, obj=obj)
+    jac = np.zeros(3)
+    if not first_order:
+        jac[:2] = (d_loss_d_r * d_r_d_m) @ metric_jac_for_fit(x, data, prior, posterior, metric_grad)
+    jac[2] = d_loss_d_r @ d_r_d_g
+    return loss(data["relevance_sliderResponse"], r, obj=obj), jac
+
+def objective_and_grad_exp_concentration_map_all_metrics(x, df, first_order=False, obj="pearson"):
+    """
+    Same as objective_function_exp_concentration_map_all_metrics, but also returns the exact gradient w.r.t. x.
+    """
+    data = prepare_fit_data(df)
+    losses, jacs = [], []
+    for metric in metrics_so:
+        l, j = objective_and_grad_exp_concentration_map(x, data, metrics_so[metric], metric_grads_so[metric], obj=obj)
+        losses.append(l)
+        jacs.append(j)
+    if first_order:
+        for metric in metrics_fo:
+            l, j = objective_and_grad_exp_concentration_map(x, data, metrics_fo[metric], first_order=True, obj=obj)
+            losses.append(l)
+            jacs.append(j)
+    return sum(losses)/len(losses), sum(jacs)/len(jacs)
+
+
+A_INIT = 2
+B_INIT = 2
+G_INIT = 2
+# G_INIT = math.e
+
+A_BOUNDS = (1, np.inf)
+B_BOUNDS = (1, np.inf)
+G_BOUNDS = (1, np.inf)
+# G_BOUNDS = (math.e, math.e)
+
+# Ranges the starting points for multi-start fits are drawn from (log-uniformly, since fitted values span orders of magnitude)
+A_START_RANGE = (1, 1000)
+B_START_RANGE = (1, 10)
+G_START_RANGE = (1, 1000)
+
+
+def fit_params(metric, data, first_order=False, obj="pearson", analytic_grad=False, x0=None):
+    """
+    Find the linking function and scaling params for one metric, or for all metrics if metric == "joint".
+    :param data: output of prepare_fit_data
+    :param first_order: only used for "joint": whether to include the first order metrics
+    :return: scipy OptimizeResult
+    """
+    x0 = np.array([A_INIT, B_INIT, G_INIT]) if x0 is None else x0
+    if metric == "joint":
+        fun = lambda x: objective_function_exp_concentration_map_all_metrics(x, data, first_order=first_order, obj=obj) \
+            if not analytic_grad else \
+            objective_and_grad_exp_concentration_map_all_metrics(x, data, first_order=first_order, obj=obj)
+        bounds = [A_BOUNDS, B_BOUNDS, G_BOUNDS]
+    elif metric in metrics_fo:
+        # First order metrics don't depend on the linking function, only g is fitted
+        fun = lambda x: objective_function_exp_concentration_map(x, data, metrics_fo[metric], obj=obj, first_order=True) \
+            if not analytic_grad else \
+            objective_and_grad_exp_concentration_map(x, data, metrics_fo[metric], obj=obj, first_order=True)
+        bounds = [(2, 2), (2, 2), G_BOUNDS]
+    else:
+        fun = lambda x: objective_function_exp_concentration_map(x, data, metrics_so[metric], obj=obj) \
+            if not analytic_grad else \
+            objective_and_grad_exp_concentration_map(x, data, metrics_so[metric], metric_grads_so[metric], obj=obj)
+        bounds = [A_BOUNDS, B_BOUNDS, G_BOUNDS]
+    return minimize(fun,
+                    # method='TNC',
+                    method='SLSQP',
+                    jac=analytic_grad,
+                    x0=x0,
+                    bounds=bounds)
+
+
+def share_fit_data(data):
+    """
+    Copy the training arrays into one shared memory block, so worker processes can read them without pickling.
+    :return: the SharedMemory object (to be closed and unlinked by the caller) and the shape of the block
+    """
+    stacked = np.stack([data[col] for col in FIT_COLUMNS])
+    shm = shared_memory.SharedMemory(create=True, size=max(stacked.nbytes, 1))
+    np.ndarray(stacked.shape, dtype=np.float64, buffer=shm.buf)[:] = stacked
+    return shm, stacked.shape
+
+
+_worker_shm = None
+_worker_data = None
+
+def _init_fit_worker(shm_name, shape):
+    global _worker_shm, _worker_data
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    block = np.ndarray(shape, dtype=np.float64, buffer=_worker_shm.buf)
+    _worker_data = {col: block[i] for i, col in enumerate(FIT_COLUMNS)}
+
+
+def _fit_worker(task):
+    metric, kwargs = task
+    return fit_params(metric, _worker_data, **kwargs)
+
+
+def starting_points(n, metric, method="sobol", seed=0):
+    """
+    :param n: number of starting points
+    :param method: 'sobol' or 'lhs' (latin hypercube)
+    :return: (n, 3) array of x0s. The first one is the usual (A_INIT, B_INIT, G_INIT), so a multi-start fit never does worse than a single fit.
+    """
+    if method == "sobol":
+        sampler = qmc.Sobol(d=3, scramble=True, seed=seed)
+    elif method == "lhs":
+        sampler = qmc.LatinHypercube(d=3, seed=seed)
+    else:
+        raise ValueError(f"Unknown sampling method: {method}")
+    with warnings.catch_warnings():
+        # Sobol points are only balanced for powers of 2, but any n is fine here
+        warnings.simplefilter("ignore", UserWarning)
+        u = sampler.random(n)
+    lower, upper = np.log(np.array([A_START_RANGE, B_START_RANGE, G_START_RANGE]).T)
+    starts = np.exp(lower + u * (upper - lower))
+    if metric in metrics_fo:
+        starts[:, :2] = 2
+    starts[0] = [A_INIT, B_INIT, G_INIT]
+    return starts
+
+
+def initial_loss(metric, x0, data, first_order=False, obj="pearson"):
+    """
+    :return: the loss that fit_params starts from at x0
+    """
+    with np.errstate(all="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        if metric == "joint":
+            return objective_function_exp_concentration_map_all_metrics(x0, data, first_order=first_order, obj=obj)
+        if metric in metrics_fo:
+            return objective_function_exp_concentration_map(x0, data, metrics_fo[metric], obj=obj, first_order=True)
+        return objective_function_exp_concentration_map(x0, data, metrics_so[metric], obj=obj)
+
+
+def finite_starting_points(metric, starts, data, first_order=False, obj="pearson"):
+    """
+    Drop the starting points where the loss is not finite (the linking function a * b^c overflows at the upper end
+    of the start ranges for some data), which SLSQP can't start from.
+    The first starting point (the usual x0) is always kept.
+    :return: the remaining starting points and the number of dropped ones
+    """
+    data = prepare_fit_data(data)
+    keep = np.array([i == 0 or np.isfinite(initial_loss(metric, x0, data, first_order=first_order, obj=obj))
+                     for i, x0 in enumerate(starts)], dtype=bool)
+    return starts[keep], int((~keep).sum())
+
+
+def run_fit_tasks(tasks, data, workers=1):
+    """
+    :param tasks: list of (metric, kwargs for fit_params) pairs
+    :param workers: number of processes; the tasks run in this process if workers <= 1
+    :return: list of results, in the order of `tasks`
+    """
+    data = prepare_fit_data(data)
+    if workers <= 1 or len(tasks) <= 1:
+        return [fit_params(metric, data, **kwargs) for metric, kwargs in tasks]
+    shm, shape = share_fit_data(data)
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)),
+                                 initializer=_init_fit_worker,
+                                 initargs=(shm.name, shape)) as pool:
+            return list(pool.map(_fit_worker, tasks, chunksize=max(1, len(tasks) // (4 * workers))))
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def fit_all_params(metrics, data, workers=1, **kwargs):
+    """
+    Fit each of `metrics` (which may include "joint") independently, in parallel if workers > 1.
+    :return: dict mapping metric to scipy OptimizeResult, in the order of `metrics`
+    """
+    results = run_fit_tasks([(metric, kwargs) for metric in metrics], data, workers=workers)
+    return dict(zip(metrics, results))
+
+
+def multistart_fit(metrics, data, n_starts, workers=1, method="sobol", seed=0, **kwargs):
+    """
+    Fit each of `metrics` from `n_starts` starting points (see starting_points) and keep the best fit.
+    :return: dict mapping metric to the best scipy OptimizeResult, and a dataframe with one row per start
+    """
+    data = prepare_fit_data(data)
+    tasks = []
+    for metric in metrics:
+        starts, n_dropped = finite_starting_points(metric, starting_points(n_starts, metric, method, seed), data,
+                                                   first_order=kwargs.get("first_order", False), obj=kwargs.get("obj", "pearson"))
+        if n_dropped:
+            print(f"{metric}: dropped {n_dropped} of {n_starts} starting points with a non-finite loss")
+        tasks.extend((metric, dict(kwargs, x0=x0)) for x0 in starts)
+    results = run_fit_tasks(tasks, data, workers=workers)
+    runs = pd.DataFrame([{
+        "metric": metric,
+        "a_init": task_kwargs["x0"][0],
+        "b_init": task_kwargs["x0"][1],
+        "g_init": task_kwargs["x0"][2],
+        "a_fit": result.x[0],
+        "b_fit": result.x[1],
+        "g_fit": result.x[2],
+        "loss": result.fun,
+        "success": result.success,
+        "nfev": result.nfev,
+        "nit": result.nit,
+    } for (metric, task_kwargs), result in zip(tasks, results)])
+    best = {}
+    for metric in metrics:
+        candidates = [result for (m, _), result in zip(tasks, results) if m == metric]
+        losses = np.array([result.fun for result in candidates], dtype=np.float64)
+        best[metric] = candidates[int(np.argmin(np.where(np.isfinite(losses), losses, np.inf)))]
+    return best, runs
+
+
+def fit_linking_params(df_train, optimize_joint="separate", first_order=False, obj="pearson", analytic_grad=False,
+                       workers=1, n_starts=1, starts="sobol", seed=0, stats=None):
+    """
+    Fit the parameters of the linking and scaling functions on the training data.
+    :param optimize_joint: whether to optimize each metric separately ('separate'), jointly ('joint'), or both ('both')
+    :param stats: dict to add the objective evaluations ("nfev") and optimizer iterations ("nit") of each fit to,
+    summed over the starts of a multi-start fit
+    :return: dict mapping each fitted metric (or "joint") to its params [a, b, g],
+    dataframe with the fitted parameters and losses of each metric,
+    and a dataframe with every start of a multi-start fit (None for single starts)
+    """
+    # Extract the training arrays once; every objective evaluation below reuses them
+    train_data = prepare_fit_data(df_train)
+
+    # Do optimization for each metric separately and/or jointly, find optimal params x
+    to_fit = []
+    if optimize_joint in ["separate", "both"]:
+        to_fit.extend(metrics_so)
+        if first_order:
+            to_fit.extend(metrics_fo)
+    if optimize_joint in ["joint", "both"]:
+        to_fit.append("joint")
+    if n_starts > 1:
+        fits, runs = multistart_fit(to_fit, train_data, n_starts, workers=workers, method=starts, seed=seed,
+                                    first_order=first_order, obj=obj, analytic_grad=analytic_grad)
+        # Spread of the optima found from the different starting points
+        print(runs.groupby("metric", sort=False)["loss"].describe().to_string())
+        print()
+    else:
+        runs = None
+        fits = fit_all_params(to_fit, train_data, workers=workers,
+                              first_order=first_order, obj=obj, analytic_grad=analytic_grad)
+    params = {metric: fit.x for metric, fit in fits.items()}
+    if stats is not None:
+        for metric, fit in fits.items():
+            if runs is None:
+                nfev, nit, n_starts_metric = fit.nfev, fit.nit, 1
+            else:
+                metric_runs = runs[runs["metric"] == metric]
+                nfev, nit, n_starts_metric = metric_runs["nfev"].sum(), metric_runs["nit"].sum(), len(metric_runs)
+            stats[metric] = {"nfev": int(nfev), "nit": int(nit), "n_starts": n_starts_metric,
+                             "loss": float(fit.fun), "success": bool(fit.success)}
+
+    for metric, x in params.items():
+        if metric == "joint":
+            print("Joint")
             print(f"{x[0]} * {x[1]}^c")
             print(f"1-{x[2]}^-x")
-            print(f"best loss: {objective_function_exp_concentration_map(x, df_train, metrics_so[metric], obj=args.obj)}")
+            vals = objective_function_exp_concentration_map_all_metrics(x, train_data, return_metric_vals=True, first_order=first_order, obj=obj)
+            print(f"best avg correlation: {-1 * vals[0]}")
+            print(f"per metric: {str({k:v for k,v in zip(metrics_so.keys(), vals[1])})}")
+        elif metric in metrics_fo:
+            print(metric)
+            print(f"1-{x[2]}^-x")
+            print(f"best loss: {objective_function_exp_concentration_map(x, train_data, metrics_fo[metric], first_order=first_order, obj=obj)}")
             print()
-
-    if args.first_order and args.optimize_joint in ["separate", "both"]:
-        for metric in metrics_fo:
+        else:
             print(metric)
-            x = minimize(lambda x: objective_function_exp_concentration_map(x, df_train, metrics_fo[metric], obj=args.obj, first_order=True),
-                         # method='TNC',
-                         method='SLSQP',
-                         x0=np.array([A_INIT, B_INIT, G_INIT])
-,
-                         bounds=[(2, 2), (2, 2), G_BOUNDS]
-                         ).x
-            params[metric] = x
+            print(f"{x[0]} * {x[1]}^c")
             print(f"1-{x[2]}^-x")
-            print(f"best loss: {objective_function_exp_concentration_map(x, df_train, metrics_fo[metric], first_order=args.first_order, obj=args.obj)}")
+            print(f"best loss: {objective_function_exp_concentration_map(x, train_data, metrics_so[metric], obj=obj)}")
             print()
 
-    if args.optimize_joint in ["joint", "both"]:
-        print("Joint")
-        x = minimize(lambda x: objective_function_exp_concentration_map_all_metrics(x, df_train, first_order=args.first_order, obj=args.obj),
-                         # method='TNC',
-                         method='SLSQP',
-                         x0=np.array([A_INIT, B_INIT, G_INIT]),
-                         bounds=[A_BOUNDS, B_BOUNDS, G_BOUNDS]
-                     ).x
-        params["joint"] = x
-        print(f"{x[0]} * {x[1]}^c")
-        print(f"1-{x[2]}^-x")
-        vals = objective_function_exp_concentration_map_all_metrics(x, df_train, return_metric_vals=True, first_order=args.first_order, obj=args.obj)
-        print(f"best avg correlation: {-1 * vals[0]}")
-        print(f"per metric: {str({k:v for k,v in zip(metrics_so.keys(), vals[1])})}")
-
-
-    # Actually compute the beta params for each item and each metric (unless we are running the grid search)
+    # Losses of the fitted params on the training data under every objective
+    results = []
+    def compile_results(use_joint=False):
+        for metric in params:
+            metric_name = metric + "_joint" if use_joint else metric
+
+            def objective(metric, obj):
+                x = params[metric] if not use_joint else params["joint"]
+                if metric == "joint":
+                    return objective_function_exp_concentration_map_all_metrics(x, train_data, first_order=first_order, obj=obj)
+                else:
+                    return objective_function_exp_concentration_map(x, train_data, all_metrics[metric], first_order=metric in metrics_fo, obj=obj)
+
+            results.append({
+                "metric": metric_name,
+                "a_fit": params[metric][0] if not use_joint else params["joint"][0],
+                "b_fit": params[metric][1] if not use_joint else params["joint"][1],
+                "g_fit": params[metric][2] if not use_joint else params["joint"][2],
+                "pearson": objective(metric, obj="pearson"),
+                "mse": objective(metric, obj="mse"),
+                "std": objective(metric, obj="std"),
+                "centrality": objective(metric, obj="centrality"),
+                "pearson_reg": objective(metric, obj="pearson_reg"),
+            })
+
+    compile_results()
+    if optimize_joint in ["both", "joint"]:
+        compile_results(use_joint=True)
+
+    return params, pd.DataFrame(results), runs
+
+
+def apply_linking_params(df, params):
+    """
+    Compute the beta params for each item and each metric.
+    :param params: params returned by fit_linking_params
+    :return: df with `<prior/posterior>_beta_for_<metric>` columns
+    """
+    for metric in params:
+        for p in ["prior", "posterior"]:
+            concentration = certainty_linking_function(params[metric], df[f"{p}_confidence"].to_numpy(dtype=np.float64))
+            a, b = fit_beta_mode_concentration(df[f"{p}_sliderResponse"].to_numpy(dtype=np.float64), concentration)
+            set_beta_params(df, f"{p}_beta_for_{metric}", a, b)
+    return df
+
+
+def linking_params_from_results(results):
+    """
+    Recover the fitted params from the dataframe returned by fit_linking_params (or its `_params.csv` file),
+    e.g. to apply frozen params to new data without refitting.
+    :return: dict mapping each fitted metric (or "joint") to its params [a, b, g]
+    """
+    # Rows ending in "_joint" are the joint params evaluated on each metric, not separate fits
+    fitted = results[~results["metric"].str.endswith("_joint")]
+    return {metric: np.array([a, b, g], dtype=np.float64)
+            for metric, a, b, g in zip(fitted["metric"], fitted["a_fit"], fitted["b_fit"], fitted["g_fit"])}
+
+
+def fit_and_apply_params(df_train, df, **kwargs):
+    """
+    Fit the linking and scaling functions on the training data (see fit_linking_params)
+    and add the beta params of each item and each metric to `df`.
+    :return: df with the beta params, dataframe with the fitted parameters and losses of each metric,
+    and a dataframe with every start of a multi-start fit (None for single starts)
+    """
+    params, results, runs = fit_linking_params(df_train, **kwargs)
+    return apply_linking_params(df, params), results, runs
+
+
+def _apply_to_round(task):
+    """
+    Read one round, add the beta params and write it out (one task of a batch run).
+    """
+    input, output, params = task
+    df = apply_linking_params(read_frame(input), params)
+    write_frame(df, output)
+    return output
+
+
+def apply_to_rounds(params, inputs, outputs, workers=1):
+    """
+    Apply the same fitted params to several rounds, in parallel if workers > 1.
+    :param inputs: results files of the rounds
+    :param outputs: output file of each round
+    """
+    tasks = [(input, output, params) for input, output in zip(inputs, outputs)]
+    if workers <= 1 or len(tasks) <= 1:
+        return [_apply_to_round(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+        return list(pool.map(_apply_to_round, tasks))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--training", help="Path to results file with `training data` for fitting beta parameters (this is probably round 1 data)")
+    parser.add_argument("--input", nargs="+", help="Path to results file with actual official results. Several rounds can be given; the params are fitted once and applied to each of them")
+    parser.add_argument("--output", nargs="+", default=[None], help="Name of output file (.parquet, .arrow, .csv or .jsonl), one for each --input")
+    parser.add_argument("--optimize_joint", default="separate", help="Whether to optimize each metric separately ('separate'), jointly ('joint'), or both ('both'), or to run a grid search ('grid')")
+    parser.add_argument("--first_order", action="store_true", help="Whether to include first order metrics.")
+    parser.add_argument("--obj", default="pearson", help="Select the optimization objective. Options: pearson, mse, std, centrality, pearson_reg")
+    parser.add_argument("--analytic_grad", action="store_true", help="Give the optimizer exact gradients instead of estimating them by finite differences.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes to run the independent metric fits in (and to apply the params to several --input rounds in).")
+    parser.add_argument("--n_starts", type=int, default=1, help="Number of starting points per fit. With more than one, the best fit is kept and all of them are saved to <output>_multistart.csv")
+    parser.add_argument("--starts", default="sobol", help="How to spread the starting points of a multi-start fit. Options: sobol, lhs")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the starting points of a multi-start fit")
+    parser.add_argument("--grid_size", type=int, default=12, help="Number of values per parameter in a grid search (--optimize_joint grid)")
+    parser.add_argument("--chunk_size", type=int, default=64, help="Number of grid points evaluated together in a grid search")
+    parser.add_argument("--checkpoint_dir", default=None, help="Directory to checkpoint a grid search to; rerunning with the same directory resumes it")
+    args = parser.parse_args()
+    if args.optimize_joint == "grid" and args.output[0] is None:
+        parser.error("A grid search needs an --output file for its losses")
+
+    df_train = read_frame(args.training, columns=FIT_COLUMNS)
+
     if args.optimize_joint in ["separate", "joint", "both"]:
-        results = []
-        def compile_results(use_joint=False):
-            for metric in params:
-                metric_name = metric + "_joint" if use_joint else metric
-                for p in ["prior", "posterior"]:
-                    df[f"{p}_concentration"] = df[f"{p}_confidence"].apply(
-                        lambda c: certainty_linking_function(params[metric], c))
-                    df[f"{p}_beta_for_{metric}"] = df.apply(
-                        lambda row: fit_beta_mode_concentration(row[f"{p}_sliderResponse"], row[f"{p}_concentration"]),
-                        axis=1)
-                    df.drop(f"{p}_concentration", axis=1, inplace=True)
-
-                def objective(metric, obj):
-                    x = params[metric] if not use_joint else params["joint"]
-                    if metric == "joint":
-                        return objective_function_exp_concentration_map_all_metrics(x, df_train, first_order=args.first_order, obj=obj)
-                    else:
-                        first_order = metric in metrics_fo
-                        return objective_function_exp_concentration_map(x, df_train, all_metrics[metric], first_order=first_order, obj=obj)
-
-                results.append({
-                    "metric": metric_name,
-                    "a_fit": params[metric][0] if not use_joint else params["joint"][0],
-                    "b_fit": params[metric][1] if not use_joint else params["joint"][1],
-                    "g_fit": params[metric][2] if not use_joint else params["joint"][2],
-                    "pearson": objective(metric, obj="pearson"),
-                    "mse": objective(metric, obj="mse"),
-                    "std": objective(metric, obj="std"),
-                    "centrality": objective(metric, obj="centrality"),
-                    "pearson_reg": objective(metric, obj="pearson_reg"),
-                })
-
-        compile_results()
-        if args.optimize_joint in ["both", "joint"]:
-            compile_results(use_joint=True)
-
-        results = pd.DataFrame(results)
-        results.to_csv(f"{args.output}_params.csv")
-        df.to_json(args.output, orient="records", lines=True)
-
-    # Run a grid search and save heatmaps
-    # if args.optimize_joint == "grid":
-    #     # First run the grid search
-    #     a = np.linspace(1.01, 5, 2)
-    #     b = np.linspace(1.01, 5, 2)
-    #     c = np.logspace(1, 100, num=2, base=1.1)
-    #     # c = np.array([1.1, 1.3, 1.8, 2.5, 5, 10, 20, 50, 200, 1000, 5000, 10000])
-    #     A, B, C = np.meshgrid(a, b, c, indexing='ij')  # shape will be (12, 12, 20)
-    #     grid = np.stack([A, B, C], axis=-1).reshape(-1, 3)
-    #     zeros = np.zeros_like(grid)
-    #     rows = []
-    #
-    #     from tqdm import tqdm
-    #     for x in tqdm(grid):
-    #         vals = objective_function_exp_concentration_map_all_metrics(x, df_train, return_metric_vals=True, return_judgments=True, first_order=args.first_order, obj=args.obj)
-    #         row = {
-    #             "a": x[0],
-    #             "b": x[1],
-    #             "r": x[2],
-    #             "avg": vals[0]
-    #         }
-    #         for i, metric in enumerate(all_metrics):
-    #             row[metric] = vals[1][i]
-    #             row["judgments"] = vals[2][i]
-    #         rows.append(row)
-    #     df_results = pd.DataFrame(rows)
-    #     df_results = df_results.set_index(["a", "b", "r"])
-    #     print(df.sort_values("avg"))
-    # #
-    # #     # Then make the heatmaps
-    #     import seaborn as sns
-    #     import matplotlib.pyplot as plt
-    #     metrics = list(all_metrics.keys()) + ["avg"]
-    #     fig, axs = plt.subplots(1, 5, figsize=(20, 3))
-    #     for metric, ax in zip(metrics, axs):
-    #         df_metric = df[[metric]].unstack().droplevel(0, axis=1)
-    #         sns.heatmap(df_metric, vmin=-0.65, vmax=-0.3, fmt=".2f", ax=ax)
-    #         ax.set_xticklabels([f"{float(item.get_text()):.2f}" for item in ax.get_xticklabels()])
-    #         ax.set_yticklabels([f"{float(item.get_text()):.2f}" for item in ax.get_yticklabels()])
-    #         ax.set_title(metric)
-    # #
-    #     plt.tight_layout()
-    #     plt.savefig(args.output)
+        if args.input is None or len(args.input) != len(args.output):
+            parser.error("Give one --output for every --input")
+        for input in args.input:
+            print(input)
+        # Fit once on the training data, then apply the params to every input round
+        params, results, runs = fit_linking_params(df_train, optimize_joint=args.optimize_joint, first_order=args.first_order,
+                                                   obj=args.obj, analytic_grad=args.analytic_grad, workers=args.workers,
+                                                   n_starts=args.n_starts, starts=args.starts, seed=args.seed)
+        for output in args.output:
+            if runs is not None:
+                runs.to_csv(f"{output}_multistart.csv")
+            results.to_csv(f"{output}_params.csv")
+        apply_to_rounds(params, args.input, args.output, workers=args.workers)
 
+    # Run a grid search and save the losses at every grid point (the data for heatmaps) to a Parquet file
+    if args.optimize_joint == "grid":
+        from grid_search import make_grid, run_grid_search
+        grid = make_grid(np.linspace(1.01, 5, args.grid_size),
+                         np.linspace(1.01, 5, args.grid_size),
+                         np.logspace(1, 100, num=args.grid_size, base=1.1))
+        df_results = run_grid_search(grid, prepare_fit_data(df_train), first_order=args.first_order, obj=args.obj,
+                                     chunk_size=args.chunk_size, workers=args.workers, checkpoint_dir=args.checkpoint_dir)
+        print(df_results.sort_values("avg"))
+        df_results.to_parquet(args.output[0])
@@ -0,0 +1,158 @@
+import os
+import pandas as pd
+from schema import apply_schema
+
+
+# Results files passed between the preprocessing stages can be stored as
+# Parquet (.parquet, .pq), Arrow IPC (.arrow, .feather, .ipc), CSV (.csv) or line-delimited JSON (anything else).
+# The format is chosen by the extension of the file name. Parquet and Arrow keep the dtypes of every column
+# and can be read column by column, so they are the better choice between stages;
+# JSON and CSV are kept for exporting results. Parquet and Arrow need pyarrow.
+FORMATS = {
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow",
+    ".ipc": "arrow",
+    ".csv": "csv",
+}
+
+
+def frame_format(path):
+    """
+    :return: "parquet", "arrow", "csv" or "jsonl"
+    """
+    path = str(path).lower()
+    for extension, fmt in FORMATS.items():
+        if path.endswith(extension):
+            return fmt
+    return "jsonl"
+
+
+def read_frame(path, columns=None):
+    """
+    Read a results file and apply the schema.
+    :param columns: only read these columns (Parquet and Arrow files don't even load the others)
+    """
+    fmt = frame_format(path)
+    if fmt == "parquet":
+        df = pd.read_parquet(path, columns=columns)
+    elif fmt == "arrow":
+        df = pd.read_feather(path, columns=columns)
+    elif fmt == "csv":
+        df = pd.read_csv(path, usecols=columns)
+    else:
+        df = pd.read_json(path, orient="records", lines=True)
+        if columns is not None:
+            df = df[columns]
+    return apply_schema(df)
+
+
+def write_frame(df, path, index=False):
+    """
+    Write a results file in the format given by the extension of `path`.
+    :param index: whether to write the index (CSV only; the other formats never store it)
+    """
+    fmt = frame_format(path)
+    if fmt == "parquet":
+        df.to_parquet(path, index=False)
+    elif fmt == "arrow":
+        df.reset_index(drop=True).to_feather(path)
+    elif fmt == "csv":
+        df.to_csv(path, index=index)
+    else:
+        df.to_json(path, orient="records", lines=True)
+
+
+def append_frame(df, path, index=False):
+    """
+    Append rows to a results file, or write it if it doesn't exist yet.
+    The rows are given the columns of the file. CSV and JSON files are appended to in place;
+    Parquet and Arrow files can't be, so they are read and written again.
+    :param index: whether the file has an index column (CSV only)
+    """
+    if not os.path.exists(path):
+        write_frame(df, path, index=index)
+        return
+    fmt = frame_format(path)
+    if fmt == "csv":
+        columns = pd.read_csv(path, nrows=0).columns
+        df = df.reindex(columns=columns[1:] if index else columns)
+        df.to_csv(path, mode="a", header=False, index=index)
+    elif fmt == "jsonl":
+        if len(df):
+            with open(path, "a") as f:
+                df.to_json(f, orient="records", lines=True)
+    else:
+        write_frame(pd.concat([read_frame(path), df], ignore_index=True), path)
+
+
+class FrameWriter:
+    """
+    Write a results file chunk by chunk, in the format given by the extension of `path`.
+    All chunks must have the same columns.
+
+    with FrameWriter(path) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    """
+    def __init__(self, path, index=False):
+        """
+        :param index: whether to write the index (CSV only)
+        """
+        self.path = path
+        self.format = frame_format(path)
+        self.index = index
+        self.n_rows = 0
+        self._file = None
+        self._writer = None
+        self._schema = None
+        self._last_chunk = None
+
+    def __enter__(self):
+        if self.format in ["csv", "jsonl"]:
+            self._file = open(self.path, "w", newline="")
+        return self
+
+    def write(self, df):
+        if self.format == "csv":
+            df.to_csv(self._file, header=self._last_chunk is None, index=self.index)
+        elif self.format == "jsonl":
+            if len(df):
+                df.to_json(self._file, orient="records", lines=True)
+        elif len(df):
+            self._write_arrow(df)
+        self._last_chunk = df
+        self.n_rows += len(df)
+
+    def _write_arrow(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        # Chunks get different categories, which Arrow files can't hold in one column;
+        # store the values instead (Parquet dictionary-encodes them anyway) and let read_frame restore the categoricals
+        df = df.astype({col: object for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)})
+        if self._schema is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            # Text columns that are empty in the first chunk would otherwise get Arrow's null type
+            self._schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                                      for field in table.schema], metadata=table.schema.metadata)
+            table = table.cast(self._schema)
+            if self.format == "parquet":
+                self._writer = pq.ParquetWriter(self.path, self._schema)
+            else:
+                self._writer = pa.ipc.new_file(self.path, self._schema)
+        else:
+            table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        elif self.format in ["parquet", "arrow"] and self._last_chunk is not None:
+            # Nothing but empty chunks: still write a file with the right columns
+            write_frame(self._last_chunk, self.path)
+        if self._file is not None:
+            self._file.close()
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,187 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import fit_beta_and_g
+from fit_beta_and_g import prepare_fit_data, share_fit_data, metrics_so, metrics_fo
+from metrics import g
+
+
+# Grid search over the linking function params (a, b) and the scaling param g of fit_beta_and_g.py.
+# Instead of evaluating the objective one grid point at a time, whole slabs of grid points are evaluated at once
+# as (grid points x rows) arrays. Slabs can be spread over several processes and are checkpointed to disk,
+# so an interrupted search picks up where it stopped.
+
+
+def make_grid(a_values, b_values, g_values):
+    """
+    :return: (n, 3) array with every combination of a, b and g
+    """
+    A, B, G = np.meshgrid(a_values, b_values, g_values, indexing='ij')
+    return np.stack([A, B, G], axis=-1).reshape(-1, 3)
+
+
+def grid_metric_names(first_order=False, metrics=None):
+    if metrics is not None:
+        return list(metrics)
+    return list(metrics_so) + (list(metrics_fo) if first_order else [])
+
+
+def hash_fit_data(data):
+    """
+    :param data: output of prepare_fit_data
+    :return: sha256 hex digest of the fit arrays, to tell whether a checkpoint was made on the same training data
+    """
+    digest = hashlib.sha256()
+    for col in sorted(data):
+        digest.update(col.encode())
+        digest.update(np.ascontiguousarray(data[col], dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def batched_beta_params(X, data, field):
+    """
+    :param X: (k, 3) or (k, 2) array of grid points
+    :return: (k * n, 2) array of beta params for `field` ('prior' or 'posterior'), grid point major
+    """
+    concentration = X[:, [0]] * (X[:, [1]] ** data[f"{field}_confidence"][None, :])
+    mode = data[f"{field}_sliderResponse"][None, :]
+    alpha, beta = fit_beta_and_g.fit_beta_mode_concentration(mode, concentration)
+    return np.column_stack([alpha.ravel(), beta.ravel()])
+
+
+def batched_loss(relevance, R, obj="pearson"):
+    """
+    Same as fit_beta_and_g.loss, for each row of R.
+    :param R: (k, n) array of scaled metric values, one row per grid point
+    :return: (k,) array of losses
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if obj in ["pearson", "pearson_reg"]:
+            y_centered = relevance - np.mean(relevance)
+            R_centered = R - np.mean(R, axis=1, keepdims=True)
+            corr = (R_centered @ y_centered) / np.sqrt(np.sum(R_centered**2, axis=1) * np.sum(y_centered**2))
+        if obj == "pearson":
+            return -corr
+        elif obj == "mse":
+            return np.mean((relevance[None, :] - R)**2, axis=1)
+        elif obj == "std":
+            return -np.std(R, axis=1)
+        elif obj == "centrality":
+            return (0.5 - np.mean(R, axis=1))**2
+        elif obj == "pearson_reg":
+            p = 0.5
+            return p * -corr + (1-p) * -np.std(R, axis=1)
+    raise ValueError(f"Unknown objective: {obj}")
+
+
+def grid_losses(X, data, first_order=False, obj="pearson", metrics=None):
+    """
+    :param X: (k, 3) array of grid points (a, b, g), or (k, 2) array of grid points (a, b) whose metrics are not scaled by g
+    :param metrics: second order metrics to evaluate instead of metrics_so (and metrics_fo if first_order)
+    :return: (k, m) array with the loss of each metric (in the order of grid_metric_names) at each grid point
+    """
+    data = prepare_fit_data(data)
+    n = len(data["relevance_sliderResponse"])
+    relevance = data["relevance_sliderResponse"]
+    scale = (lambda r: g(r, X[:, [2]])) if X.shape[1] == 3 else (lambda r: r)
+    prior = batched_beta_params(X, data, "prior")
+    posterior = batched_beta_params(X, data, "posterior")
+    losses = []
+    with np.errstate(all="ignore"):
+        for metric, f in (metrics_so if metrics is None else metrics).items():
+            R = scale(f(prior, posterior).reshape(len(X), n))
+            losses.append(batched_loss(relevance, R, obj=obj))
+        if first_order and metrics is None:
+            for metric in metrics_fo:
+                r = metrics_fo[metric](data["prior_sliderResponse"], data["posterior_sliderResponse"])
+                R = scale(np.broadcast_to(r, (len(X), n)))
+                losses.append(batched_loss(relevance, R, obj=obj))
+    return np.column_stack(losses)
+
+
+def _grid_worker(slab, first_order, obj, metrics):
+    return grid_losses(slab, fit_beta_and_g._worker_data, first_order=first_order, obj=obj, metrics=metrics)
+
+
+def _load_checkpoint(checkpoint_dir, grid, settings):
+    """
+    :return: dict mapping slab index to the losses saved for that slab
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    grid_path = os.path.join(checkpoint_dir, "grid.npy")
+    settings_path = os.path.join(checkpoint_dir, "settings.json")
+    if os.path.exists(grid_path):
+        with open(settings_path) as f:
+            saved_settings = json.load(f)
+        if saved_settings != settings or not np.array_equal(np.load(grid_path), grid):
+            raise ValueError(f"{checkpoint_dir} holds a checkpoint for a different grid search")
+    else:
+        np.save(grid_path, grid)
+        with open(settings_path, "w") as f:
+            json.dump(settings, f)
+    done = {}
+    for filename in os.listdir(checkpoint_dir):
+        if filename.startswith("slab_") and filename.endswith(".npy"):
+            done[int(filename[5:-4])] = np.load(os.path.join(checkpoint_dir, filename))
+    return done
+
+
+def _save_slab(checkpoint_dir, i, losses):
+    path = os.path.join(checkpoint_dir, f"slab_{i:06d}.npy")
+    # Write to a temporary file first so a killed run never leaves a truncated slab behind
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, losses)
+    os.replace(path + ".tmp", path)
+
+
+def run_grid_search(grid, data, first_order=False, obj="pearson", chunk_size=64, workers=1, checkpoint_dir=None,
+                    metrics=None):
+    """
+    :param grid: (k, 3) array of grid points, e.g. from make_grid, or (k, 2) array of (a, b) without scaling by g
+    :param chunk_size: number of grid points evaluated together; memory use grows with chunk_size * number of rows
+    :param workers: number of processes
+    :param checkpoint_dir: if given, finished slabs are saved here and skipped when the search is run again
+    :param metrics: second order metrics to evaluate instead of the ones of fit_beta_and_g.py (must be picklable if workers > 1)
+    :return: dataframe with columns a, b, g (for a (k, 3) grid), avg and one loss column per metric
+    """
+    data = prepare_fit_data(data)
+    slabs = [grid[i:i + chunk_size] for i in range(0, len(grid), chunk_size)]
+    names = grid_metric_names(first_order, metrics)
+    # A checkpoint only belongs to this search if it was made on the same training data
+    settings = {"first_order": first_order, "obj": obj, "chunk_size": chunk_size, "metrics": names,
+                "data": hash_fit_data(data)}
+    done = _load_checkpoint(checkpoint_dir, grid, settings) if checkpoint_dir else {}
+    todo = [i for i in range(len(slabs)) if i not in done]
+
+    def finish(i, losses):
+        done[i] = losses
+        if checkpoint_dir:
+            _save_slab(checkpoint_dir, i, losses)
+
+    if workers <= 1 or len(todo) <= 1:
+        for i in todo:
+            finish(i, grid_losses(slabs[i], data, first_order=first_order, obj=obj, metrics=metrics))
+    else:
+        shm, shape = share_fit_data(data)
+        try:
+            with ProcessPoolExecutor(max_workers=workers,
+                                     initializer=fit_beta_and_g._init_fit_worker,
+                                     initargs=(shm.name, shape)) as pool:
+                futures = {pool.submit(_grid_worker, slabs[i], first_order, obj, metrics): i for i in todo}
+                for future in as_completed(futures):
+                    finish(futures[future], future.result())
+        finally:
+            shm.close()
+            shm.unlink()
+
+    losses = np.concatenate([done[i] for i in range(len(slabs))]) if slabs else np.empty((0, len(names)))
+    results = pd.DataFrame(losses, columns=names)
+    results.insert(0, "avg", np.mean(losses, axis=1))
+    if grid.shape[1] == 3:
+        results.insert(0, "g", grid[:, 2])
+    results.insert(0, "b", grid[:, 1])
+    results.insert(0, "a", grid[:, 0])
+    return results
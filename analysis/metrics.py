@@ -1,7 +1,10 @@
 import numpy as np
 import math
+import hashlib
+import weakref
+from collections import OrderedDict
 from scipy.stats import entropy
-from scipy.special import loggamma, digamma, gamma
+from scipy.special import loggamma, digamma, gamma, polygamma
 
 def kl(p, q):
     """
@@ -134,16 +137,10 @@ def entropy_dirichlet(P):
     https://en.wikipedia.org/wiki/Beta_distribution#Quantities_of_information_(entropy)
     """
     a0 = sum(P)
-    try:
-        to_return = math.log(math.prod([gamma(a) for a in P]) / gamma(a0)) \
-               + (a0 - len(P)) * digamma(a0) \
-               - sum([(p - 1) * digamma(p) for p in P])
-
-        if np.isnan(to_return):
-            to_return = -5
-    except ValueError:
-        to_return = -5
-    return to_return
+    # Work with log(gamma) directly: gamma overflows for params above ~170
+    return sum([loggamma(a) for a in P]) - loggamma(a0) \
+        + (a0 - len(P)) * digamma(a0) \
+        - sum([(p - 1) * digamma(p) for p in P])
 
 
 def entropy_reduction_dirichlet(P, Q):
@@ -186,4 +183,409 @@ def pure_second_order_belief_change(P, Q):
     :param Q: posterior params for dirichlet dist.
     :return:
     """
-    return abs(P[0] + P[1] - (Q[0] + Q[1]))
\ No newline at end of file
+    return abs(P[0] + P[1] - (Q[0] + Q[1]))
+
+# Vectorized versions of the metrics above.
+# First-order metrics take arrays of probabilities of equal shape.
+# Dirichlet metrics take (n, k) arrays of parameters, one distribution per row (for beta distributions k = 2).
+# All of them return an array with one value per row and keep the edge-case behavior of the scalar versions.
+
+def _as_params(P):
+    return np.atleast_2d(np.asarray(P, dtype=np.float64))
+
+
+SPECIAL_FUNCTIONS = {
+    "gamma": gamma,
+    "loggamma": loggamma,
+    "digamma": digamma,
+    "trigamma": lambda x: polygamma(1, x),
+}
+
+
+class SpecialFunctionCache:
+    """
+    Memoizes the special functions of dirichlet params.
+    The fitting scripts evaluate several metrics (and their gradients) on the same prior and posterior params arrays,
+    so results are kept in a bounded LRU store keyed by the identity of the params array and a small digest of it
+    (hashing the whole array would cost as much as the functions themselves on large inputs).
+    Results that would not fit in max_bytes are computed without being stored.
+    """
+    def __init__(self, max_bytes=2**27, digest_rows=64):
+        # Upper bound on the memory held by the stored results
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # Number of rows sampled into the digest, to notice arrays that were changed in place or reused ids
+        self.digest_rows = digest_rows
+        self.hits = 0
+        self.misses = 0
+        # (id, shape, digest of params) -> (weak reference to params, {function name: (f(P), f(P.sum(axis=1)))})
+        self._store = OrderedDict()
+
+    def _key(self, P):
+        sample = P[np.linspace(0, len(P) - 1, min(len(P), self.digest_rows)).astype(np.intp)]
+        digest = hashlib.blake2b(sample.tobytes() + P.sum(axis=0).tobytes(), digest_size=16).digest()
+        return id(P), P.shape, digest
+
+    def __call__(self, P, *names):
+        """
+        :param P: (n, k) array of params for dirichlet dists.
+        :param names: names of functions in SPECIAL_FUNCTIONS
+        :return: for each name, f(P) as an (n, k) array and f(P.sum(axis=1)) as an (n,) array
+        """
+        P = _as_params(P)
+        # Each function stores f(P) and f(P.sum(axis=1))
+        entry_nbytes = P.shape[0] * (P.shape[1] + 1) * P.itemsize
+        if entry_nbytes > self.max_bytes:
+            self.misses += len(names)
+            return [self._evaluate(P, name) for name in names]
+        key = self._key(P)
+        if key in self._store and self._store[key][0]() is P:
+            self._store.move_to_end(key)
+        else:
+            self._drop(key)
+            self._store[key] = (weakref.ref(P), {})
+        values = self._store[key][1]
+        to_return = []
+        for name in names:
+            if name in values:
+                self.hits += 1
+            else:
+                self.misses += 1
+                values[name] = self._evaluate(P, name)
+                self.nbytes += sum(value.nbytes for value in values[name])
+            to_return.append(values[name])
+        while self.nbytes > self.max_bytes and len(self._store) > 1:
+            self._drop(next(iter(self._store)))
+        return to_return
+
+    @staticmethod
+    def _evaluate(P, name):
+        f = SPECIAL_FUNCTIONS[name]
+        values = f(P), f(P.sum(axis=1))
+        for value in values:
+            value.flags.writeable = False
+        return values
+
+    def _drop(self, key):
+        if key in self._store:
+            _, values = self._store.pop(key)
+            self.nbytes -= sum(value.nbytes for pair in values.values() for value in pair)
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._store),
+                "nbytes": self.nbytes, "max_bytes": self.max_bytes}
+
+    def clear(self):
+        self._store.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+special_function_cache = SpecialFunctionCache()
+
+
+def kl_vec(p, q):
+    """
+    :param p: array of posteriors
+    :param q: array of priors
+    :return: KL divergence for each (p, q) pair
+    """
+    p = np.asarray(p, dtype=np.float64)
+    q = np.asarray(q, dtype=np.float64)
+    return entropy(np.stack([p, 1-p]), np.stack([q, 1-q]), base=2, axis=0)
+
+
+def kl_util_vec(p, q):
+    """
+    :param p: array of posteriors
+    :param q: array of priors
+    :return:
+    """
+    return g(kl_vec(p, q))
+
+
+def entropy_reduction_vec(p, q):
+    """
+    :param p: array of priors
+    :param q: array of posteriors
+    :return: Absolute value of entropy reduction for each (p, q) pair
+    """
+    p = np.asarray(p, dtype=np.float64)
+    q = np.asarray(q, dtype=np.float64)
+    return np.abs(entropy(np.stack([p, 1-p]), base=2, axis=0) - entropy(np.stack([q, 1-q]), base=2, axis=0))
+
+
+def bayes_factor_vec(p, q):
+    """
+    :param p: array of posteriors
+    :param q: array of priors
+    :return: bayes factor for each (p, q) pair
+    """
+    p = np.asarray(p, dtype=np.float64)
+    q = np.asarray(q, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bf = (p / (1-p)) * ((1-q) / q)
+    return np.where((p == 1) & (q == 1) | (p == 0) & (q == 0), 1.0, bf)
+
+
+def log_bayes_factor_vec(p, q):
+    """
+    :param p: array of posteriors
+    :param q: array of priors
+    :return: absolute value of log of bayes factor for each (p, q) pair
+    """
+    p = np.asarray(p, dtype=np.float64)
+    q = np.asarray(q, dtype=np.float64)
+    with np.errstate(divide="ignore"):
+        lbf = np.abs(np.log10(bayes_factor_vec(p, q)))
+    return np.where((p == 1) & (q == 1) | (p == 0) & (q == 0), 0.0, lbf)
+
+
+def bf_utility_polar_vec(p, q):
+    """
+    :param p: array of posteriors
+    :param q: array of priors
+    """
+    p = np.asarray(p, dtype=np.float64)
+    q = np.asarray(q, dtype=np.float64)
+    flip = p > q
+    return 1 - bayes_factor_vec(np.where(flip, 1 - p, p), np.where(flip, 1 - q, q))
+
+
+def bf_utility_multi_avg_vec(p_list, q_list):
+    """
+    :param p_list: (n, k) array, one row of posteriors per question
+    :param q_list: (n, k) array, one row of priors per question
+    :return:
+    """
+    return np.mean(bf_utility_polar_vec(p_list, q_list), axis=-1)
+
+
+def bf_utility_multi_weighted_avg_vec(p_list, q_list):
+    """
+    :param p_list: (n, k) array, one row of posteriors per question
+    :param q_list: (n, k) array, one row of priors per question
+    :return:
+    """
+    p_list = np.asarray(p_list, dtype=np.float64)
+    return np.sum(p_list * bf_utility_polar_vec(p_list, q_list), axis=-1)
+
+
+def posterior_distance_vec(p):
+    """
+    :param p: array of posteriors
+    :return: How far on a scale of 0 to 1 each p is from 0.5
+    """
+    return 2 * np.abs(0.5 - np.asarray(p, dtype=np.float64))
+
+
+def prior_posterior_distance_vec(p, q):
+    """
+    :param p: array of priors
+    :param q: array of posteriors
+    :return: Distance between p and q
+    """
+    return np.abs(np.asarray(p) - np.asarray(q))
+
+
+def kl_dirichlet_vec(Q, P):
+    """
+    :param Q: (n, k) array of posterior params for dirichlet dists.
+    :param P: (n, k) array of prior params for dirichlet dists.
+    Row-wise version of kl_dirichlet.
+    """
+    Q = _as_params(Q)
+    P = _as_params(P)
+    (loggamma_Q, loggamma_Q0), (digamma_Q, digamma_Q0) = special_function_cache(Q, "loggamma", "digamma")
+    (loggamma_P, loggamma_P0), = special_function_cache(P, "loggamma")
+    return loggamma_Q0 - loggamma_P0 + \
+        (loggamma_P - loggamma_Q).sum(axis=1) + \
+        ((Q - P) * (digamma_Q - digamma_Q0[:, None])).sum(axis=1)
+
+
+def kl_util_dirichlet_vec(Q, P):
+    """
+    :param Q: (n, k) array of posterior params for dirichlet dists.
+    :param P: (n, k) array of prior params for dirichlet dists.
+    """
+    return g(kl_dirichlet_vec(Q, P))
+
+
+def entropy_dirichlet_vec(P, return_fallback=False):
+    """
+    Row-wise version of entropy_dirichlet.
+    :param P: (n, k) array of params for dirichlet dists.
+    :param return_fallback: also return a boolean mask of the rows for which earlier versions of entropy_dirichlet
+    overflowed and returned -5 instead of the entropy (see entropy_dirichlet_fallback_rows)
+    """
+    P = _as_params(P)
+    a0 = P.sum(axis=1)
+    (loggamma_P, loggamma_a0), (digamma_P, digamma_a0) = special_function_cache(P, "loggamma", "digamma")
+    to_return = loggamma_P.sum(axis=1) - loggamma_a0 \
+        + (a0 - P.shape[1]) * digamma_a0 \
+        - ((P - 1) * digamma_P).sum(axis=1)
+    if return_fallback:
+        return to_return, entropy_dirichlet_fallback_rows(P)
+    return to_return
+
+
+def entropy_dirichlet_fallback_rows(P):
+    """
+    Earlier versions of entropy_dirichlet computed log(prod(gamma(P)) / gamma(sum(P))), which overflows
+    once the concentration gets above ~170, and returned -5 whenever that happened.
+    :param P: (n, k) array of params for dirichlet dists.
+    :return: boolean mask of the rows that got the -5 fallback value
+    """
+    P = _as_params(P)
+    a0 = P.sum(axis=1)
+    (gamma_P, gamma_a0), (digamma_P, digamma_a0) = special_function_cache(P, "gamma", "digamma")
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        ratio = np.prod(gamma_P, axis=1) / gamma_a0
+        old = np.log(ratio) \
+            + (a0 - P.shape[1]) * digamma_a0 \
+            - ((P - 1) * digamma_P).sum(axis=1)
+    return np.isnan(old) | ~(ratio > 0)
+
+
+def entropy_reduction_dirichlet_vec(P, Q):
+    """
+    :param P: (n, k) array of prior params for dirichlet dists.
+    :param Q: (n, k) array of posterior params for dirichlet dists.
+    :return: Entropy reduction
+    """
+    return np.abs(entropy_dirichlet_vec(P) - entropy_dirichlet_vec(Q))
+
+
+def beta_bayes_factor_vec(P, Q):
+    """
+    :param P: (n, 2) array of prior params for beta dists.
+    :param Q: (n, 2) array of posterior params for beta dists.
+    :return:
+    """
+    P = _as_params(P)
+    Q = _as_params(Q)
+    return np.abs(P[:, 0] - Q[:, 0]) + np.abs(P[:, 1] - Q[:, 1])
+
+
+def beta_bayes_factor_util_vec(P, Q):
+    """
+    :param P: (n, 2) array of prior params for beta dists.
+    :param Q: (n, 2) array of posterior params for beta dists.
+    :return:
+    """
+    return np.log(beta_bayes_factor_vec(P, Q) + 2)
+
+
+def beta_bayes_factor_util_1_vec(P, Q):
+    """
+    :param P: (n, 2) array of prior params for beta dists.
+    :param Q: (n, 2) array of posterior params for beta dists.
+    :return:
+    """
+    return np.log(beta_bayes_factor_vec(P, Q) + 1)
+
+
+def pure_second_order_belief_change_vec(P, Q):
+    """
+    :param P: (n, 2) array of prior params for beta dists.
+    :param Q: (n, 2) array of posterior params for beta dists.
+    :return:
+    """
+    P = _as_params(P)
+    Q = _as_params(Q)
+    return np.abs(P[:, 0] + P[:, 1] - (Q[:, 0] + Q[:, 1]))
+
+
+# Derivatives of the vectorized metrics, used to give the optimizers in fit_beta.py and fit_beta_and_g.py exact gradients.
+# Each *_grad function returns the derivatives w.r.t. each of its arguments, in argument order,
+# as arrays of the same shape as that argument. |x| is differentiated as sign(x).
+
+def g_grad(x, b=math.e):
+    """
+    :return: derivatives of g(x, b) w.r.t. x and w.r.t. b
+    """
+    b_pow = b ** (-1 * x - 1)
+    with np.errstate(invalid="ignore"):
+        # x = inf gives g = 1 for every b
+        d_b = np.where(b_pow == 0, 0.0, x * b_pow)
+    return np.log(b) * (b ** (-1 * x)), d_b
+
+
+def kl_dirichlet_vec_grad(Q, P):
+    """
+    :param Q: (n, k) array of posterior params for dirichlet dists.
+    :param P: (n, k) array of prior params for dirichlet dists.
+    :return: derivatives of kl_dirichlet_vec(Q, P) w.r.t. Q and P
+    """
+    Q = _as_params(Q)
+    P = _as_params(P)
+    (digamma_Q, digamma_Q0), (trigamma_Q, trigamma_Q0) = special_function_cache(Q, "digamma", "trigamma")
+    (digamma_P, digamma_P0), = special_function_cache(P, "digamma")
+    d_Q = (Q - P) * trigamma_Q - trigamma_Q0[:, None] * (Q - P).sum(axis=1, keepdims=True)
+    d_P = digamma_P - digamma_P0[:, None] - (digamma_Q - digamma_Q0[:, None])
+    return d_Q, d_P
+
+
+def kl_util_dirichlet_vec_grad(Q, P):
+    """
+    :return: derivatives of kl_util_dirichlet_vec(Q, P) w.r.t. Q and P
+    """
+    d_g = g_grad(kl_dirichlet_vec(Q, P))[0][:, None]
+    d_Q, d_P = kl_dirichlet_vec_grad(Q, P)
+    return d_g * d_Q, d_g * d_P
+
+
+def entropy_dirichlet_vec_grad(P):
+    """
+    :return: derivative of entropy_dirichlet_vec(P) w.r.t. P
+    """
+    P = _as_params(P)
+    P0 = P.sum(axis=1)[:, None]
+    (trigamma_P, trigamma_P0), = special_function_cache(P, "trigamma")
+    d_P = (P0 - P.shape[1]) * trigamma_P0[:, None] - (P - 1) * trigamma_P
+    return d_P
+
+
+def entropy_reduction_dirichlet_vec_grad(P, Q):
+    """
+    :return: derivatives of entropy_reduction_dirichlet_vec(P, Q) w.r.t. P and Q
+    """
+    sign = np.sign(entropy_dirichlet_vec(P) - entropy_dirichlet_vec(Q))[:, None]
+    return sign * entropy_dirichlet_vec_grad(P), -sign * entropy_dirichlet_vec_grad(Q)
+
+
+def beta_bayes_factor_vec_grad(P, Q):
+    """
+    :return: derivatives of beta_bayes_factor_vec(P, Q) w.r.t. P and Q
+    """
+    sign = np.sign(_as_params(P) - _as_params(Q))
+    return sign, -sign
+
+
+def beta_bayes_factor_util_vec_grad(P, Q):
+    """
+    :return: derivatives of beta_bayes_factor_util_vec(P, Q) w.r.t. P and Q
+    """
+    d_log = (1 / (beta_bayes_factor_vec(P, Q) + 2))[:, None]
+    d_P, d_Q = beta_bayes_factor_vec_grad(P, Q)
+    return d_log * d_P, d_log * d_Q
+
+
+def beta_bayes_factor_util_1_vec_grad(P, Q):
+    """
+    :return: derivatives of beta_bayes_factor_util_1_vec(P, Q) w.r.t. P and Q
+    """
+    d_log = (1 / (beta_bayes_factor_vec(P, Q) + 1))[:, None]
+    d_P, d_Q = beta_bayes_factor_vec_grad(P, Q)
+    return d_log * d_P, d_log * d_Q
+
+
+def pure_second_order_belief_change_vec_grad(P, Q):
+    """
+    :return: derivatives of pure_second_order_belief_change_vec(P, Q) w.r.t. P and Q
+    """
+    P = _as_params(P)
+    Q = _as_params(Q)
+    sign = np.sign(P[:, 0] + P[:, 1] - (Q[:, 0] + Q[:, 1]))[:, None]
+    return np.repeat(sign, 2, axis=1), -np.repeat(sign, 2, axis=1)
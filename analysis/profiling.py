@@ -0,0 +1,100 @@
+import json
+import os
+import platform
+import sys
+import time
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Opt-in instrumentation of the pipeline stages in run_pipeline.py (--profile report.json).
+# Each stage gets a record with its wall time, peak RSS, rows in and out, and, for the fit stage,
+# the objective evaluations and optimizer iterations of every fit. The records are written to a JSON report.
+#
+# Peak RSS is the high-water mark of this process during the stage: on Linux it is reset at the start of every stage,
+# elsewhere it is the high-water mark since the process started. Fits run with --workers N use other processes,
+# whose memory is not included.
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of this process (Linux only).
+    :return: whether the peak was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """
+    :return: peak RSS of this process in MiB (since the last reset_peak_rss on Linux), or None if unknown
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+class Profiler:
+    """
+    Collect one record per pipeline stage.
+
+    profiler.start_stage()
+    ... run the stage ...
+    profiler.record(pipeline, stage, wall_time, rows_in=..., rows_out=..., fits=...)
+    profiler.write("report.json")
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.records = []
+        self.peak_is_per_stage = False
+
+    def start_stage(self):
+        self.peak_is_per_stage = reset_peak_rss()
+
+    def record(self, pipeline, stage, wall_time, rows_in=None, rows_out=None, **details):
+        """
+        :param wall_time: wall time of the stage in seconds
+        :param rows_in: rows the stage started with (rows read from the raw responses for the qualify stage)
+        :param rows_out: rows the stage returned
+        :param details: anything else to report, e.g. "fits" (objective evaluations and iterations per fit) or "cache"
+        """
+        self.records.append({
+            "pipeline": pipeline,
+            "stage": stage,
+            "wall_time_s": wall_time,
+            "peak_rss_mb": peak_rss_mb(),
+            "rows_in": rows_in,
+            "rows_out": rows_out,
+            "rows_dropped": rows_in - rows_out if rows_in is not None and rows_out is not None else None,
+            **{key: value for key, value in details.items() if value is not None},
+        })
+
+    def report(self):
+        return {
+            "argv": sys.argv,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "python": platform.python_version(),
+            "pid": os.getpid(),
+            "peak_rss_per_stage": self.peak_is_per_stage,
+            "total_wall_time_s": sum(record["wall_time_s"] for record in self.records),
+            "stages": self.records,
+        }
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2, default=float)
@@ -1,70 +1,196 @@
 import argparse
 import pandas as pd
 import numpy as np
+from schema import read_dtypes, apply_schema
+from frame_io import FrameWriter
+
+
+# The raw magpie exports are read in chunks, twice:
+# the first pass only parses SCORE_COLUMNS and keeps per-participant accumulators (passed checks, experiment durations),
+# the second pass adds the scores to each chunk and appends it to the output file.
+# Memory use therefore depends on the chunk size and the number of participants, not on the size of the export.
+# Both passes read with the dtypes of schema.RAW_DTYPES, so every chunk gets the same dtypes;
+# columns that are not in the schema are parsed chunk by chunk and should be added to it.
+
+# Columns needed to score participants and compute the summary statistics
+SCORE_COLUMNS = ["submission_id", "TrialType", "p_min", "p_max", "sliderResponse",
+                 "certainty_min", "certainty_max", "confidence", "experiment_duration"]
+# Columns written for relevance-only experiments
+RELEVANCE_ONLY_COLUMNS = ["submission_id", "group", "StimID", "AnswerCertainty", "AnswerPolarity", "ContextType",
+                          "attention_score", "reasoning_score", "sliderResponse"]
+
+
+def count_passed_checks(df, trial_type, check_confidence=True):
+    """
+    :param df: raw responses
+    :param trial_type: "attention" or "reasoning"
+    :param check_confidence: whether the confidence of each trial is checked in addition to the probability
+    :return: dataframe with the number of passed checks ("passed") and of all checks ("checks")
+    on `trial_type` trials for each submission_id
+    """
+    trials = df[df["TrialType"] == trial_type]
+    passed = {"correct_p": trials["sliderResponse"].between(trials["p_min"], trials["p_max"])}
+    if check_confidence:
+        passed["correct_c"] = trials["confidence"].between(trials["certainty_min"], trials["certainty_max"])
+    # Every check of every trial counts the same, so the score is the fraction of passed checks over all trials
+    passed = pd.DataFrame({"submission_id": trials["submission_id"], **passed}).melt(id_vars="submission_id")
+    return passed.groupby("submission_id")["value"].agg(passed="sum", checks="count")
+
+
+def read_chunks(path, columns=None, chunksize=100000):
+    """
+    :param columns: only parse these columns (columns missing from the file are skipped)
+    :return: iterator over chunks of the raw responses, with the dtypes of the schema
+    """
+    usecols = None if columns is None else (lambda c: c in columns)
+    return pd.read_csv(path, usecols=usecols, dtype=read_dtypes(columns), chunksize=chunksize)
+
+
+def select_submissions(df, exclude_pilot=False, exclude_round1=False, submission_ids=None):
+    if exclude_pilot:
+        df = df[df.submission_id >= 3008]  # Exclude responses from beta testers (i.e. authors & friends)
+        df = df[~df.submission_id.isin([3008, 3009])]  # Exclude responses from pilot 0.1. The p_min/p_max for attention check were wrong
+        df = df[~df.submission_id.isin([3031])]  # Exclude author test
+
+    if exclude_round1:
+        df = df[df.submission_id >= 5000]  # All results from round 1 have submission ID less than 5000. This also excludes pilot data
+
+    if submission_ids is not None:
+        df = df[df.submission_id.isin(submission_ids)]  # Only process these submissions (incremental runs)
+    return df
+
+
+def prepare_chunk(df, exclude_pilot=False, exclude_round1=False, submission_ids=None):
+    df = select_submissions(df, exclude_pilot=exclude_pilot, exclude_round1=exclude_round1, submission_ids=submission_ids)
+
+    # Make percents into probabilities
+    df = df.copy()
+    df["sliderResponse"] = df["sliderResponse"].astype("float64")/100
+    return df
+
+
+def read_submission_ids(raw_responses, exclude_pilot=False, exclude_round1=False, chunksize=100000):
+    """
+    :return: set of the submission_ids in a magpie .csv file that are not excluded
+    """
+    submission_ids = set()
+    for chunk in read_chunks(raw_responses, columns=["submission_id"], chunksize=chunksize):
+        chunk = select_submissions(chunk, exclude_pilot=exclude_pilot, exclude_round1=exclude_round1)
+        submission_ids.update(chunk["submission_id"].unique())
+    return submission_ids
+
+
+def median_from_counts(counts):
+    """
+    :param counts: series mapping each value to the number of times it occurs
+    :return: median of all values
+    """
+    counts = counts.groupby(level=0).sum().sort_index()
+    if counts.sum() == 0:
+        return np.nan
+    cumulative = counts.cumsum().to_numpy()
+    n = cumulative[-1]
+    lower = counts.index[np.searchsorted(cumulative, (n - 1) // 2, side="right")]
+    upper = counts.index[np.searchsorted(cumulative, n // 2, side="right")]
+    return (lower + upper) / 2
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--raw_responses", help="Relative path to a magpie .csv file containing the raw responses from the participants")
-parser.add_argument("--output", help="Name of output file")
-parser.add_argument("--exclude_pilot", action="store_true", help="Does the data include pilot data? Some pre-processing is necessary to address inconsistencies.")
-parser.add_argument("--exclude_round1", action="store_true", help="Does the data include round 1 data?")
-parser.add_argument("--relevance-only", action="store_true", help="Is this for a relevance-only experiment?")
-args = parser.parse_args()
 
 ATTENTION_PASS_THRESHOLD = 1
 REASONING_PASS_THRESHOLD = 0.5
 
 
+def score_participants(raw_responses, exclude_pilot=False, exclude_round1=False, relevance_only=False, chunksize=100000,
+                       submission_ids=None):
+    """
+    First pass: accumulate per-participant results and print the summary statistics.
+    :return: dict mapping "attention" and "reasoning" to a series with the score of each submission_id
+    """
+    passed_checks = {"attention": [], "reasoning": []}
+    durations = []
+    participants = set()
+    for chunk in read_chunks(raw_responses, columns=SCORE_COLUMNS, chunksize=chunksize):
+        chunk = prepare_chunk(chunk, exclude_pilot=exclude_pilot, exclude_round1=exclude_round1, submission_ids=submission_ids)
+        for trial_type in passed_checks:
+            passed_checks[trial_type].append(count_passed_checks(chunk, trial_type, check_confidence=not relevance_only))
+        durations.append(chunk["experiment_duration"].value_counts())
+        participants.update(chunk["submission_id"].unique())
+
+    metadata = {}
+
+    # Calculate average time
+    experiment_duration_median = median_from_counts(pd.concat(durations)) / 60000
+    print(f"Median experiment duration: {experiment_duration_median:.0f} minutes")
+    metadata["experiment_duration_median"] = experiment_duration_median
+
+    # Number of participants
+    n_participants = len(participants)
+    print(f"Total number of participants: {n_participants}")
+    metadata["n_participants"] = n_participants
+
+    # Quality checks
+    scores = {}
+    for trial_type in passed_checks:
+        counts = pd.concat(passed_checks[trial_type]).groupby(level=0).sum()
+        scores[trial_type] = counts["passed"] / counts["checks"]
+    return scores
+
+
+def scored_chunks(raw_responses, scores, exclude_pilot=False, exclude_round1=False, relevance_only=False,
+                  chunksize=100000, submission_ids=None, stats=None):
+    """
+    Second pass: add the scores to each chunk of the raw responses.
+    :param scores: scores returned by score_participants
+    :param stats: dict to count the rows read from the raw responses in ("rows_read")
+    :return: iterator over the scored chunks
+    """
+    # Relevance-only results keep a few columns of the main trials; otherwise every column is kept
+    output_columns = RELEVANCE_ONLY_COLUMNS + ["TrialType"] if relevance_only else None
+    n_rows = 0
+    for chunk in read_chunks(raw_responses, columns=output_columns, chunksize=chunksize):
+        if stats is not None:
+            stats["rows_read"] = stats.get("rows_read", 0) + len(chunk)
+        chunk = prepare_chunk(chunk, exclude_pilot=exclude_pilot, exclude_round1=exclude_round1, submission_ids=submission_ids)
+        for trial_type in scores:
+            chunk[f'{trial_type}_score'] = chunk["submission_id"].map(scores[trial_type])
+        if relevance_only:
+            chunk = chunk[chunk["TrialType"] == "main"][RELEVANCE_ONLY_COLUMNS]
+            chunk.index = pd.RangeIndex(n_rows, n_rows + len(chunk))
+        n_rows += len(chunk)
+        yield chunk
+
+
+def qualify_participants(raw_responses, output=None, exclude_pilot=False, exclude_round1=False, relevance_only=False,
+                         chunksize=100000, submission_ids=None, stats=None):
+    """
+    Score each participant on the attention and reasoning checks and add the scores to their responses.
+    :param raw_responses: path to a magpie .csv file containing the raw responses from the participants
+    :param output: file to stream the results to; if None, the results are returned
+    :param submission_ids: only process these submissions (all of them if None)
+    :param stats: dict to count the rows read from the raw responses in ("rows_read")
+    :return: dataframe with the scored responses, or None if they were written to `output`
+    """
+    options = dict(exclude_pilot=exclude_pilot, exclude_round1=exclude_round1, relevance_only=relevance_only,
+                   chunksize=chunksize, submission_ids=submission_ids)
+    scores = score_participants(raw_responses, **options)
+    chunks = scored_chunks(raw_responses, scores, stats=stats, **options)
+    if output is None:
+        # Chunks have different categories, so the categoricals are restored after concatenating
+        return apply_schema(pd.concat(list(chunks), ignore_index=True))
+    with FrameWriter(output, index=relevance_only) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+
 
-df = pd.read_csv(args.raw_responses)
-if args.exclude_pilot:
-    df = df[df.submission_id.apply(lambda x: x >= 3008)]  # Exclude responses from beta testers (i.e. authors & friends)
-    df = df[df.submission_id.apply(lambda x: x not in [3008, 3009])]  # Exclude responses from pilot 0.1. The p_min/p_max for attention check were wrong
-    df = df[df.submission_id.apply(lambda x: x not in [3031])]  # Exclude author test
-
-if args.exclude_round1:
-    df = df[df.submission_id.apply(lambda x: x >= 5000)]  # All results from round 1 have submission ID less than 5000. This also excludes pilot data
-
-# Make percents into probabilities
-df["sliderResponse"] = df["sliderResponse"]/100
-
-metadata = {}
-
-# Calculate average time
-experiment_duration_median = df["experiment_duration"].median() / 60000
-print(f"Median experiment duration: {round(experiment_duration_median)} minutes")
-metadata["experiment_duration_median"] = experiment_duration_median
-
-# Number of participants
-n_participants = len(df.submission_id.unique())
-print(f"Total number of participants: {n_participants}")
-metadata["n_participants"] = n_participants
-
-# Quality checks
-df_qual = pd.DataFrame(index=df.submission_id.unique())
-
-if args.relevance_only:
-    for trial_type, threshold in zip(["attention", "reasoning"], [ATTENTION_PASS_THRESHOLD, REASONING_PASS_THRESHOLD]):
-        df_tmp = df[df["TrialType"] == trial_type][["submission_id",
-                                                    "p_min", "p_max", "sliderResponse"]]
-        df_tmp["correct_p"] = df_tmp.apply(lambda x: x["sliderResponse"] <= x["p_max"] and x["sliderResponse"] >= x["p_min"], axis=1)
-        df_tmp = df_tmp[["submission_id", "correct_p"]].set_index("submission_id").stack().droplevel(1)
-        df_tmp = pd.DataFrame(df_tmp).pivot_table(index="submission_id", aggfunc=np.mean)
-        df[f'{trial_type}_score'] = df["submission_id"].apply(lambda x: df_tmp.loc[x])
-    df = df[df["TrialType"] == "main"].reset_index()
-    df = df[[
-        "submission_id", "group", "StimID", "AnswerCertainty", "AnswerPolarity", "ContextType", "attention_score",
-        "reasoning_score", "sliderResponse"
-    ]]
-    df.to_csv(path_or_buf=args.output)
-else:
-    for trial_type, threshold in zip(["attention", "reasoning"], [ATTENTION_PASS_THRESHOLD, REASONING_PASS_THRESHOLD]):
-        df_tmp = df[df["TrialType"] == trial_type][["submission_id",
-                                                    "p_min", "p_max", "sliderResponse",
-                                                    "certainty_max", "certainty_min", "confidence"]]
-        df_tmp["correct_p"] = df_tmp.apply(lambda x: x["sliderResponse"] <= x["p_max"] and x["sliderResponse"] >= x["p_min"], axis=1)
-        df_tmp["correct_c"] = df_tmp.apply(lambda x: x["confidence"] <= x["certainty_max"] and x["confidence"] >= x["certainty_min"], axis=1)
-        df_tmp = df_tmp[["submission_id", "correct_p", "correct_c"]].set_index("submission_id").stack().droplevel(1)
-        df_tmp = pd.DataFrame(df_tmp).pivot_table(index="submission_id", aggfunc=np.mean)
-        df[f'{trial_type}_score'] = df["submission_id"].apply(lambda x: df_tmp.loc[x])
-    df.to_json(path_or_buf=args.output, orient="records", lines=True)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--raw_responses", help="Relative path to a magpie .csv file containing the raw responses from the participants")
+    parser.add_argument("--output", help="Name of output file (.parquet, .arrow, .csv or .jsonl; .csv for relevance-only experiments)")
+    parser.add_argument("--exclude_pilot", action="store_true", help="Does the data include pilot data? Some pre-processing is necessary to address inconsistencies.")
+    parser.add_argument("--exclude_round1", action="store_true", help="Does the data include round 1 data?")
+    parser.add_argument("--relevance-only", action="store_true", help="Is this for a relevance-only experiment?")
+    parser.add_argument("--chunksize", type=int, default=100000, help="Number of rows of the raw responses to hold in memory at a time.")
+    args = parser.parse_args()
 
+    qualify_participants(args.raw_responses, output=args.output, exclude_pilot=args.exclude_pilot,
+                         exclude_round1=args.exclude_round1, relevance_only=args.relevance_only,
+                         chunksize=args.chunksize)
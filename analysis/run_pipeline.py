@@ -0,0 +1,301 @@
+import argparse
+import json
+import time
+from pathlib import Path
+import pandas as pd
+from frame_io import read_frame, write_frame, append_frame
+from qualify_participants import qualify_participants, read_submission_ids
+from widen_dataframe import wrangle_data
+from fit_beta_and_g import fit_linking_params, apply_linking_params, linking_params_from_results, FIT_COLUMNS
+from compute_metrics import compute_metrics, scale_metrics
+from finalize_preprocessing import finalize
+from stage_cache import StageCache, hash_file
+from profiling import Profiler
+
+
+# Runs the post-processing steps of README.md as stages in one process, passing the results between them in memory.
+# Each round is described by a small JSON file in pipelines/ (or anywhere else):
+#
+# {
+#     "raw_responses": "results/round_2.0/results_80_relevance-answers.csv",  # input of the qualify stage
+#     "stages": ["qualify", "widen", "fit", "compute_metrics", "finalize"],   # optional, this is the default
+#     "qualify": {"exclude_round1": true},                                    # keyword arguments of each stage
+#     "training": "round_1.0",            # config of the round the fit is trained on (its qualify and widen stages are run);
+#                                         # "training_data" gives a widened results file instead,
+#                                         # and without either the round is fitted on its own data
+#     "fit": {"optimize_joint": "separate", "obj": "mse", "first_order": true},
+#     "compute_metrics": {"scale": true},
+#     "save": {"fit": "results/round_2.0/results_beta.parquet", "params": "results/round_2.0/results_beta_params.csv"},
+#     "output": "results/round_2.0/results_pipeline.csv"
+# }
+#
+# Paths are relative to the project root. A pipeline that doesn't start with the qualify stage reads its
+# results from "input" (and the scaling parameters from "params" if it doesn't run the fit stage).
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+CONFIG_DIR = Path(__file__).resolve().parent / "pipelines"
+STAGES = ["qualify", "widen", "fit", "compute_metrics", "finalize"]
+
+
+def project_path(path):
+    return PROJECT_ROOT / path
+
+
+def load_config(config):
+    """
+    :param config: path to a pipeline config, or the name of one in pipelines/ (e.g. "round_2.0")
+    :return: dict with the config; "name" defaults to the file name
+    """
+    path = Path(config)
+    if not path.exists():
+        path = CONFIG_DIR / f"{config}.json"
+    with open(path) as f:
+        config = json.load(f)
+    config.setdefault("name", path.stem)
+    return config
+
+
+def run_qualify(state, config):
+    state["df"] = qualify_participants(project_path(config["raw_responses"]), stats=state["stage_stats"],
+                                       **config.get("qualify", {}))
+
+
+def run_widen(state, config):
+    state["df"] = wrangle_data(state["df"], **config.get("widen", {}))
+
+
+def prepare_training(state, config):
+    """
+    Get the training data of the fit stage, and the key it is cached under.
+    """
+    if "training_data" in config:
+        path = project_path(config["training_data"])
+        state["df_train"] = read_frame(path, columns=FIT_COLUMNS)
+        state["training_key"] = hash_file(path)
+    elif "training" not in config:
+        # The fit adds columns to the data of the round, so the training data is a copy
+        state["df_train"] = state["df"][FIT_COLUMNS].copy()
+        state["training_key"] = state["key"]
+    else:
+        # Another round: only its qualify and widen stages are needed
+        training_config = {key: value for key, value in load_config(config["training"]).items()
+                           if key not in ["save", "output"]}
+        training_config["stages"] = ["qualify", "widen"]
+        training_state = _run_stages(training_config, state["timings"], state["cache"], state["fitted"],
+                                     profiler=state["profiler"])
+        state["df_train"] = training_state["df"][FIT_COLUMNS].copy()
+        state["training_key"] = training_state["key"]
+
+
+def run_fit(state, config):
+    if state["frozen_params"] is not None:
+        # Incremental runs apply the params of the last full run
+        state["params"] = state["frozen_params"]
+        state["df"] = apply_linking_params(state["df"], linking_params_from_results(state["params"]))
+        return
+    # Rounds trained on the same data with the same options share one fit,
+    # whether the data is their own or that of another round
+    fit_key = (state["training_key"], json.dumps(config.get("fit", {}), sort_keys=True))
+    if fit_key in state["fitted"]:
+        fitted = state["fitted"][fit_key]
+    else:
+        state["stage_stats"]["fits"] = {}
+        fitted = fit_linking_params(state["df_train"], stats=state["stage_stats"]["fits"], **config.get("fit", {}))
+        state["fitted"][fit_key] = fitted
+    linking_params, state["params"], state["runs"] = fitted
+    state["df"] = apply_linking_params(state["df"], linking_params)
+
+
+def run_compute_metrics(state, config):
+    options = dict(config.get("compute_metrics", {}))
+    scale = options.pop("scale", False)
+    joint = options.get("joint", "separate")
+    df = compute_metrics(state["df"], prior_colname='prior_sliderResponse', posterior_colname='posterior_sliderResponse',
+                         **options)
+    if scale:
+        df_params = state.get("params")
+        if df_params is None:
+            df_params = pd.read_csv(project_path(config["params"]), index_col=0)
+        df = scale_metrics(df, df_params[["metric", "g_fit"]].set_index("metric"), joint=joint)
+    state["df"] = df
+
+
+def run_finalize(state, config):
+    state["df"] = finalize(state["df"])
+
+
+STAGE_FUNCTIONS = {
+    "qualify": run_qualify,
+    "widen": run_widen,
+    "fit": run_fit,
+    "compute_metrics": run_compute_metrics,
+    "finalize": run_finalize,
+}
+
+
+def _stage_inputs(stage, state, config):
+    """
+    :return: keys of the inputs of `stage` besides the output of the previous stage
+    """
+    if stage == "fit" and state["frozen_params"] is None:
+        return [state["training_key"]]
+    if stage == "compute_metrics" and state["params"] is None and "params" in config:
+        return [hash_file(project_path(config["params"]))]
+    return []
+
+
+def _run_stages(config, timings, cache, fitted, frozen_params=None, profiler=None):
+    """
+    :return: dict with the results ("df"), the fitted parameters ("params") and the key ("key") of the last stage;
+    the keys address the cache and the shared fits, so they are computed without a cache too
+    """
+    stages = config.get("stages", STAGES)
+    unknown = [stage for stage in stages if stage not in STAGE_FUNCTIONS]
+    if unknown:
+        raise ValueError(f"Unknown stages {unknown} in pipeline {config['name']}. Options: {STAGES}")
+    state = {"df": None, "params": None, "runs": None, "key": None, "timings": timings, "cache": cache, "fitted": fitted,
+             "frozen_params": frozen_params, "profiler": profiler}
+    first_input = config["raw_responses"] if stages[0] == "qualify" else config["input"]
+    if stages[0] != "qualify":
+        state["df"] = read_frame(project_path(first_input))
+    state["key"] = hash_file(project_path(first_input))
+    save = config.get("save", {})
+    for stage in stages:
+        if state["df"] is not None and state["df"].empty:
+            print(f"{config['name']}: nothing left to process before {stage}")
+            break
+        rows_in = None if state["df"] is None else len(state["df"])
+        state["stage_stats"] = {}
+        cached = None
+        if profiler is not None:
+            profiler.start_stage()
+        start = time.perf_counter()
+        nested = sum(timings.values())
+        if stage == "fit" and frozen_params is None:
+            prepare_training(state, config)
+        key = StageCache.key(stage, [state["key"]] + _stage_inputs(stage, state, config), config.get(stage, {}))
+        if cache is None:
+            STAGE_FUNCTIONS[stage](state, config)
+        else:
+            frames = cache.load(key)
+            cached = frames is not None
+            if frames is None:
+                STAGE_FUNCTIONS[stage](state, config)
+                frames = {"df": state["df"]}
+                if stage == "fit":
+                    frames.update(params=state["params"], runs=state["runs"])
+                cache.store(key, frames, stage=stage, pipeline=config["name"], params=config.get(stage, {}))
+            else:
+                state.update(frames)
+        state["key"] = key
+        # Stages of a training pipeline run by this stage are timed on their own
+        nested = sum(timings.values()) - nested
+        wall_time = time.perf_counter() - start - nested
+        name = f"{config['name']}/{stage}"
+        timings[name] = timings.get(name, 0) + wall_time
+        if profiler is not None:
+            profiler.record(config["name"], stage, wall_time, rows_in=state["stage_stats"].get("rows_read", rows_in),
+                            rows_out=len(state["df"]), cached=cached, fits=state["stage_stats"].get("fits"))
+        if stage in save:
+            write_frame(state["df"], project_path(save[stage]), index=True)
+        if stage == "fit":
+            if state["runs"] is not None and "multistart" in save:
+                state["runs"].to_csv(project_path(save["multistart"]))
+            if "params" in save:
+                state["params"].to_csv(project_path(save["params"]))
+    if "output" in config:
+        write_frame(state["df"], project_path(config["output"]), index=True)
+    return state
+
+
+def run_pipeline(config, timings=None, cache=None, fitted=None, profiler=None):
+    """
+    Run the stages of a pipeline config one after the other.
+    :param config: dict returned by load_config
+    :param timings: dict to add the wall time (in seconds) of each stage to, keyed by "<config name>/<stage>"
+    (stages that run more than once, like the stages of a training round, add up)
+    :param cache: StageCache to reuse the outputs of stages whose inputs, options and code did not change (None to run every stage)
+    :param fitted: dict of fits to share between pipelines; pass the same dict to every pipeline of a batch,
+    and rounds trained on the same data with the same fit options are only fitted once
+    (a round fitted on its own data shares its fit with the rounds trained on it)
+    :param profiler: Profiler to record the wall time, peak RSS, rows and fit statistics of each stage in (None to not profile)
+    :return: the results of the last stage
+    """
+    return _run_stages(config, {} if timings is None else timings, cache, {} if fitted is None else fitted,
+                       profiler=profiler)["df"]
+
+
+def run_incremental(config, timings=None, profiler=None):
+    """
+    Process only the submissions that are not in the output file yet, and append them to it.
+    The fit stage does not refit: it applies the params saved by the last full run ("params", or "params" under "save").
+    :param config: dict returned by load_config; the pipeline must start with the qualify stage and have an "output"
+    :param timings: as for run_pipeline
+    :param profiler: as for run_pipeline
+    :return: the appended rows (None if there were none)
+    """
+    timings = {} if timings is None else timings
+    stages = config.get("stages", STAGES)
+    output = project_path(config["output"])
+    if stages[0] != "qualify" or not output.exists():
+        raise ValueError(f"Incremental runs of pipeline {config['name']} append to the output of a full run; run it in full first")
+    frozen_params = None
+    if "fit" in stages:
+        params = config.get("params", config.get("save", {}).get("params"))
+        if params is None or not project_path(params).exists():
+            raise ValueError(f"Pipeline {config['name']} has no saved params to apply; run it in full first")
+        # The params are applied exactly as they were fitted (the default float parser may be off in the last digit)
+        frozen_params = pd.read_csv(project_path(params), index_col=0, float_precision="round_trip")
+
+    processed = read_frame(output, columns=["submission_id"])["submission_id"]
+    qualify_options = config.get("qualify", {})
+    new_submissions = read_submission_ids(project_path(config["raw_responses"]),
+                                          exclude_pilot=qualify_options.get("exclude_pilot", False),
+                                          exclude_round1=qualify_options.get("exclude_round1", False)) - set(processed)
+    print(f"{config['name']}: {len(new_submissions)} new submissions")
+    if not new_submissions:
+        return None
+    config = {key: value for key, value in config.items() if key not in ["save", "output"]}
+    config["qualify"] = {**qualify_options, "submission_ids": sorted(new_submissions)}
+    state = _run_stages(config, timings, None, {}, frozen_params=frozen_params, profiler=profiler)
+    df = state["df"]
+    if df is None or df.empty:
+        return None
+    # Continue the index of the output file
+    df = df.set_axis(pd.RangeIndex(len(processed), len(processed) + len(df)))
+    append_frame(df, output, index=True)
+    return df
+
+
+def print_timings(timings):
+    print("Stage timings:")
+    for stage, seconds in timings.items():
+        print(f"  {stage:<40} {seconds:8.2f} s")
+    print(f"  {'total':<40} {sum(timings.values()):8.2f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configs", nargs="+", help="Pipeline configs to run: paths to .json files, or names of files in pipelines/ (round_1.0, round_2.0, relevance-only)")
+    parser.add_argument("--cache_dir", default=None, help="Directory to cache the output of each stage in; stages whose input data, options and source files did not change are not rerun")
+    parser.add_argument("--incremental", action="store_true", help="Only process the submissions that are not in the output file of each config yet, with the params saved by its last full run, and append them to the output file")
+    parser.add_argument("--profile", default=None, help="Write a JSON report with the wall time, peak RSS, rows in/out and, for fits, objective evaluations and optimizer iterations of each stage to this file")
+    parser.add_argument("--cache_max_bytes", type=float, default=None, help="After the run, evict the least recently used cache entries until the cache takes at most this many bytes")
+    args = parser.parse_args()
+
+    cache = StageCache(args.cache_dir) if args.cache_dir else None
+    profiler = Profiler() if args.profile else None
+    timings = {}
+    fitted = {}
+    for config in args.configs:
+        if args.incremental:
+            run_incremental(load_config(config), timings=timings, profiler=profiler)
+        else:
+            run_pipeline(load_config(config), timings=timings, cache=cache, fitted=fitted, profiler=profiler)
+    print_timings(timings)
+    if cache is not None:
+        print(f"Stage cache: {cache.hits} hits, {cache.misses} misses")
+        if args.cache_max_bytes is not None:
+            cache.evict(max_bytes=args.cache_max_bytes)
+    if profiler is not None:
+        profiler.write(args.profile)
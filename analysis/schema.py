@@ -0,0 +1,75 @@
+import pandas as pd
+
+
+# Dtypes of the columns of the raw magpie exports, and of the columns they keep in later stages.
+# Every reader applies these at load time:
+# categorical columns only have a handful of distinct values,
+# and ids, counters and timestamps fit in smaller ints than the default int64.
+# The integer columns use pandas' nullable dtypes ("Int32" etc.), so that an export with an empty cell can still be read
+# (NumPy ints can't hold missing values); sliderResponse becomes a float64 probability in qualify_participants.py.
+# Columns that go into metrics, fits or the attention/reasoning checks
+# (sliderResponse once divided by 100, confidence, p_min, p_max, certainty_min, certainty_max) stay float64,
+# so that the results do not depend on the schema.
+CATEGORICAL_COLUMNS = [
+    "AnswerCertainty",
+    "AnswerPolarity",
+    "ContextType",
+    "TaskType",
+    "TrialType",
+    "group",
+    "education",
+    "gender",
+    "languages",
+    "experimentType",
+]
+
+RAW_DTYPES = {
+    **{col: "category" for col in CATEGORICAL_COLUMNS},
+    "submission_id": "Int32",
+    "StimID": "Int16",
+    "trialNr": "Int16",
+    # Slider positions are percentages 0-100
+    "sliderResponse": "Int8",
+    "age": "float32",
+    "certainty_min": "float64",
+    "certainty_max": "float64",
+    "confidence": "float64",
+    "p_min": "float64",
+    "p_max": "float64",
+    "experiment_duration": "Int32",
+    "experiment_start_time": "Int64",
+    "experiment_end_time": "Int64",
+    "response_time": "Int32",
+    "responseTime": "Int32",
+    "comments": "str",
+    "prolific_pid": "str",
+    "prolific_session_id": "str",
+    "prolific_study_id": "str",
+}
+
+
+def read_dtypes(columns=None):
+    """
+    :param columns: columns that will be read (all schema columns if None)
+    :return: dtype argument for pd.read_csv
+    """
+    if columns is None:
+        return dict(RAW_DTYPES)
+    return {col: dtype for col, dtype in RAW_DTYPES.items() if col in columns}
+
+
+def apply_schema(df):
+    """
+    Cast the columns of `df` that are in the schema, e.g. after reading a .jsonl file.
+    Only integer columns are narrowed to smaller ints: columns holding missing values are floats,
+    and sliderResponse is a float once it has been turned into a probability.
+    :return: df with the schema dtypes
+    """
+    dtypes = {}
+    for col, dtype in RAW_DTYPES.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        if pd.api.types.is_integer_dtype(dtype) and not pd.api.types.is_integer_dtype(df[col]):
+            continue
+        dtypes[col] = dtype
+    return df.astype(dtypes)
@@ -0,0 +1,208 @@
+import argparse
+import ast
+import hashlib
+import json
+import shutil
+import time
+from pathlib import Path
+import pandas as pd
+from frame_io import read_frame, write_frame
+
+
+# Cache of the outputs of the pipeline stages in run_pipeline.py.
+# An entry is addressed by a hash of everything its output depends on:
+# the keys of its inputs (the hash of the raw responses file for the first stage, the key of the previous stage otherwise),
+# the options of the stage (the same as the command line arguments of its script) and the source files it runs:
+# the script of the stage, the modules of the analysis directory it imports (directly or not) and run_pipeline.py.
+# Changing compute_metrics.py therefore only invalidates the compute_metrics and finalize stages,
+# while changing frame_io.py or schema.py invalidates every stage.
+#
+# Each entry is a directory <cache_dir>/<key> with the output frames as Parquet files and a meta.json
+# describing the entry. `python stage_cache.py <cache_dir> list` shows the entries,
+# `python stage_cache.py <cache_dir> evict --max_bytes ... --max_age ...` removes the least recently used ones.
+
+ANALYSIS_DIR = Path(__file__).resolve().parent
+
+# Script of each stage
+STAGE_SCRIPTS = {
+    "qualify": "qualify_participants.py",
+    "widen": "widen_dataframe.py",
+    "fit": "fit_beta_and_g.py",
+    "compute_metrics": "compute_metrics.py",
+    "finalize": "finalize_preprocessing.py",
+}
+
+
+def local_imports(file):
+    """
+    :param file: file name in the analysis directory
+    :return: sorted names of the files in the analysis directory that `file` imports, directly or not, and `file` itself
+    """
+    found = set()
+    pending = [file]
+    while pending:
+        current = pending.pop()
+        if current in found:
+            continue
+        found.add(current)
+        for node in ast.walk(ast.parse((ANALYSIS_DIR / current).read_text())):
+            if isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module is not None:
+                modules = [node.module]
+            else:
+                continue
+            pending += [f"{module}.py" for module in modules if (ANALYSIS_DIR / f"{module}.py").exists()]
+    return sorted(found)
+
+
+# Source files whose code determines the output of each stage.
+# run_pipeline.py runs every stage; its imports are not followed as they include the scripts of all stages.
+STAGE_SOURCES = {stage: local_imports(script) + ["run_pipeline.py"] for stage, script in STAGE_SCRIPTS.items()}
+
+
+def hash_file(path):
+    """
+    :return: sha256 hex digest of the contents of the file
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_sources(files):
+    """
+    :param files: file names in the analysis directory
+    :return: dict mapping each file to the hash of its contents
+    """
+    return {file: hash_file(ANALYSIS_DIR / file) for file in files}
+
+
+class StageCache:
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(stage, inputs, params, sources=None):
+        """
+        :param stage: name of the stage
+        :param inputs: keys or file hashes of the inputs of the stage
+        :param params: options of the stage (must be JSON serializable)
+        :param sources: source files of the stage (STAGE_SOURCES[stage] by default)
+        :return: key of the output of the stage
+        """
+        sources = STAGE_SOURCES[stage] if sources is None else sources
+        description = {"stage": stage, "inputs": list(inputs), "params": params, "sources": hash_sources(sources)}
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _entry_dir(self, key):
+        return self.directory / key
+
+    def load(self, key):
+        """
+        :return: dict with the frames stored under `key`, or None if there is no such entry
+        """
+        entry_dir = self._entry_dir(key)
+        meta_path = entry_dir / "meta.json"
+        if not meta_path.exists():
+            self.misses += 1
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        frames = {name: read_frame(entry_dir / f"{name}.parquet") for name in meta["frames"]}
+        meta["last_used"] = time.time()
+        with open(meta_path, "w") as f:
+            json.dump(meta, f, indent=2)
+        self.hits += 1
+        return frames
+
+    def store(self, key, frames, **meta):
+        """
+        :param frames: dict of dataframes to store under `key` (None values are skipped)
+        :param meta: extra fields for meta.json, e.g. the stage and its options
+        """
+        entry_dir = self._entry_dir(key)
+        # Write to a temporary directory first, so that an interrupted run never leaves a partial entry behind
+        tmp_dir = self.directory / f".{key}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir()
+        frames = {name: df for name, df in frames.items() if df is not None}
+        for name, df in frames.items():
+            write_frame(df, tmp_dir / f"{name}.parquet")
+        now = time.time()
+        meta = {**meta, "key": key, "frames": list(frames), "n_rows": len(frames["df"]) if "df" in frames else None,
+                "created": now, "last_used": now,
+                "bytes": sum(f.stat().st_size for f in tmp_dir.iterdir())}
+        with open(tmp_dir / "meta.json", "w") as f:
+            json.dump(meta, f, indent=2, default=str)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        tmp_dir.rename(entry_dir)
+
+    def entries(self):
+        """
+        :return: dataframe with one row per entry (key, stage, pipeline, rows, bytes, created, last_used),
+        most recently used first
+        """
+        entries = []
+        for meta_path in self.directory.glob("*/meta.json"):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            entries.append({field: meta.get(field) for field in
+                            ["key", "stage", "pipeline", "n_rows", "bytes", "created", "last_used"]})
+        df = pd.DataFrame(entries, columns=["key", "stage", "pipeline", "n_rows", "bytes", "created", "last_used"])
+        for col in ["created", "last_used"]:
+            df[col] = pd.to_datetime(df[col], unit="s")
+        return df.sort_values("last_used", ascending=False, ignore_index=True)
+
+    def remove(self, key):
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def evict(self, max_bytes=None, max_age=None):
+        """
+        Remove entries that were not used for `max_age` seconds, then the least recently used entries
+        until the cache takes at most `max_bytes`.
+        :return: keys of the removed entries
+        """
+        entries = self.entries()
+        removed = []
+        if max_age is not None:
+            too_old = entries["last_used"] < pd.to_datetime(time.time() - max_age, unit="s")
+            removed.extend(entries.loc[too_old, "key"])
+            entries = entries[~too_old]
+        if max_bytes is not None:
+            # Entries are sorted by last use, so everything after the first `max_bytes` goes
+            over = entries["bytes"].cumsum() > max_bytes
+            removed.extend(entries.loc[over, "key"])
+        for key in removed:
+            self.remove(key)
+        return removed
+
+    def clear(self):
+        for key in self.entries()["key"]:
+            self.remove(key)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cache_dir", help="Directory of the stage cache")
+    parser.add_argument("command", choices=["list", "evict", "clear"], help="List the entries, evict some of them, or remove all of them")
+    parser.add_argument("--max_bytes", type=float, default=None, help="Evict the least recently used entries until the cache takes at most this many bytes")
+    parser.add_argument("--max_age", type=float, default=None, help="Evict the entries that were not used for this many days")
+    args = parser.parse_args()
+
+    cache = StageCache(args.cache_dir)
+    if args.command == "list":
+        entries = cache.entries()
+        print(entries.to_string(index=False))
+        print(f"{len(entries)} entries, {entries['bytes'].sum() / 2**20:.1f} MiB")
+    elif args.command == "evict":
+        max_age = None if args.max_age is None else args.max_age * 86400
+        removed = cache.evict(max_bytes=args.max_bytes, max_age=max_age)
+        print(f"Evicted {len(removed)} entries")
+    else:
+        cache.clear()
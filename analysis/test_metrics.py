@@ -0,0 +1,66 @@
+import time
+import numpy as np
+from scipy.special import loggamma, digamma
+from metrics import SpecialFunctionCache, kl_dirichlet_vec, special_function_cache
+
+
+def random_params(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(1, 50, size=(n, 2))
+
+
+def test_cache_hits_on_the_same_array():
+    cache = SpecialFunctionCache()
+    P = random_params(1000)
+    (lg, lg0), = cache(P, "loggamma")
+    (lg_again, _), (dg, dg0) = cache(P, "loggamma", "digamma")
+    assert lg_again is lg
+    assert cache.info()["hits"] == 1 and cache.info()["misses"] == 2
+    np.testing.assert_array_equal(lg, loggamma(P))
+    np.testing.assert_array_equal(dg0, digamma(P.sum(axis=1)))
+
+
+def test_cache_notices_changed_arrays():
+    cache = SpecialFunctionCache()
+    P = random_params(1000)
+    cache(P, "loggamma")
+    P[:] += 1
+    (lg, _), = cache(P, "loggamma")
+    np.testing.assert_array_equal(lg, loggamma(P))
+
+
+def test_cache_counts_each_result_once():
+    cache = SpecialFunctionCache()
+    P = random_params(1000)
+    cache(P, "loggamma", "digamma")
+    assert cache.info()["nbytes"] == 2 * (P.nbytes + P.shape[0] * P.itemsize)
+
+
+def test_cache_skips_results_larger_than_max_bytes():
+    cache = SpecialFunctionCache(max_bytes=2**20)
+    P = random_params(100000)
+    (lg, _), = cache(P, "loggamma")
+    np.testing.assert_array_equal(lg, loggamma(P))
+    assert cache.info()["entries"] == 0 and cache.info()["nbytes"] == 0
+
+
+def test_cache_miss_costs_about_as_much_as_no_cache():
+    P = random_params(1000000)
+    Q = random_params(1000000, seed=1)
+
+    def uncached():
+        Q0, P0 = Q.sum(axis=1), P.sum(axis=1)
+        return (loggamma(Q0) - loggamma(Q).sum(axis=1) - loggamma(P0) + loggamma(P).sum(axis=1)
+                + ((Q - P) * (digamma(Q) - digamma(Q0)[:, None])).sum(axis=1))
+
+    def best_time(f, repeat=3):
+        times = []
+        for _ in range(repeat):
+            special_function_cache.clear()
+            start = time.perf_counter()
+            f()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    np.testing.assert_allclose(kl_dirichlet_vec(Q, P), uncached())
+    assert best_time(lambda: kl_dirichlet_vec(Q, P)) < 2 * best_time(uncached)
@@ -0,0 +1,32 @@
+import io
+import pandas as pd
+from schema import read_dtypes, apply_schema
+from qualify_participants import read_chunks, prepare_chunk
+
+CSV = """submission_id,StimID,TrialType,sliderResponse,confidence,experiment_duration
+5001,1,main,40,3,600000
+5001,2,main,,4,600000
+5002,1,main,75,,
+"""
+
+
+def test_blank_slider_response_is_read_as_missing():
+    df = pd.read_csv(io.StringIO(CSV), dtype=read_dtypes())
+    assert df["sliderResponse"].isna().tolist() == [False, True, False]
+    assert df["experiment_duration"].isna().tolist() == [False, False, True]
+    assert df["submission_id"].tolist() == [5001, 5001, 5002]
+
+
+def test_blank_slider_response_becomes_nan_probability(tmp_path):
+    path = tmp_path / "raw.csv"
+    path.write_text(CSV)
+    chunk = prepare_chunk(next(read_chunks(path)))
+    assert chunk["sliderResponse"].dtype == "float64"
+    assert chunk["sliderResponse"].iloc[0] == 0.4
+    assert pd.isna(chunk["sliderResponse"].iloc[1])
+
+
+def test_apply_schema_keeps_floats_with_missing_values():
+    df = apply_schema(pd.DataFrame({"StimID": [1.0, None], "submission_id": [5001, 5002]}))
+    assert df["StimID"].dtype == "float64"
+    assert df["submission_id"].dtype == "Int32"
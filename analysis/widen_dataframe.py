@@ -1,6 +1,30 @@
 import numpy as np
 import pandas as pd
 import argparse
+from frame_io import read_frame, write_frame
+
+
+# Values that become one column per TaskType, in the (sorted) order pivot_table gives them
+VALUES = ['confidence', 'sliderResponse']
+
+
+def unstack_responses(df_long, index):
+    """
+    Reshape without aggregating, for when every (index, TaskType) cell holds one response.
+    :return: wide dataframe with (value, TaskType) columns, or None if some cells hold more than one response
+    """
+    keys = index + ['TaskType']
+    # Leave out the rows that pivot_table's groupby would drop for missing keys (the check and practice trials);
+    # AnswerPolarity is missing for answers without polarity, and those rows are kept
+    has_keys = df_long[[key for key in keys if key != 'AnswerPolarity']].notna().all(axis=1)
+    df_long = df_long.loc[has_keys, keys + VALUES]
+    try:
+        df_wide = df_long.set_index(keys).unstack('TaskType')
+    except ValueError:
+        # "Index contains duplicate entries": unstack checks uniqueness while building the reshape
+        return None
+    # As pivot_table does, drop rows and columns without any values
+    return df_wide.dropna(how='all').dropna(axis=1, how='all').reset_index()
 
 
 def wrangle_data(df_long, aggregrate_participants=False, aggregate_group=False):
@@ -22,10 +46,13 @@ def wrangle_data(df_long, aggregrate_participants=False, aggregate_group=False):
     if aggregate_group:
         index.remove('group')
     # Pivot dataframe so that TaskType values (prior/posterior/helpfulness) become columns
-    df_long["AnswerPolarity"] = df_long["AnswerPolarity"].fillna('dummy')
-    df_wide = df_long.pivot_table(index=index, columns='TaskType',
-                                  values=['sliderResponse', 'confidence']
-                                  ).reset_index().replace('dummy', np.nan)
+    df_wide = None
+    if not (aggregrate_participants or aggregate_group):
+        df_wide = unstack_responses(df_long, index)
+    if df_wide is None:
+        df_long = df_long.assign(AnswerPolarity=df_long["AnswerPolarity"].astype(object).fillna('dummy'))
+        df_wide = df_long.pivot_table(index=index, columns='TaskType', values=VALUES, observed=True
+                                      ).reset_index().replace('dummy', np.nan)
     # Collapse multi-indexing: (SliderResponse, prior) -> SliderResponse__prior
     df_wide.columns = [
         '_'.join(reversed(col)).strip().lstrip('_')
@@ -39,12 +66,12 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--input",
                         help="Relative path to a magpie .csv file containing the raw responses from the participants")
-    parser.add_argument("--output", default=None, help="Name of output file")
+    parser.add_argument("--output", default=None, help="Name of output file (.parquet, .arrow, .csv or .jsonl)")
     args = parser.parse_args()
     # Read filtered data from csv
-    df = pd.read_json(args.input, orient="records", lines=True)
+    df = read_frame(args.input)
     # Widen dataframe
     df = wrangle_data(df)
     # Get outfile
     output = args.output if args.output else args.input
-    df.to_json(output, orient="records", lines=True)
+    write_frame(df, output)
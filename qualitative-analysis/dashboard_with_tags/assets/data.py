@@ -1,16 +1,85 @@
+import threading
+from functools import lru_cache
 from pathlib import Path
 import pandas as pd
+import pyarrow.parquet as pq
+from assets.snapshot import build_snapshot, snapshot_is_current
 
 relevance_dir = Path(__file__).resolve().parent.parent.parent.parent
 
-data_path = relevance_dir / 'qualitative-analysis' / 'data' / 'processed_data_with_stimuli.csv'
+data_path = relevance_dir / 'qualitative-analysis' / 'data' / 'processed_data_dashboard.csv'
+stimuli_path = relevance_dir / 'qualitative-analysis' / 'data' / 'stimuli.csv'
+# Typed copy of data_path that can be read column by column (written by merge-stimuli.py, or rebuilt when data_path changes)
+snapshot_path = data_path.with_suffix('.parquet')
 
 TAGS_FILE_PATH = relevance_dir / 'qualitative-analysis' / 'data' / 'saved_tags.txt'
 
-d = pd.read_csv(data_path)
+class LazyFrame:
+    '''
+    The columns of a Parquet snapshot, read the first time they are needed.
+    The snapshot is rebuilt from the csv file first if it is missing or out of date.
+    '''
+    def __init__(self, source, snapshot):
+        self.source = source
+        self.snapshot = snapshot
+        self.loaded = {}
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._file is None:
+            if not snapshot_is_current(self.source, self.snapshot):
+                build_snapshot(self.source, self.snapshot)
+            self._file = pq.ParquetFile(self.snapshot, memory_map=True)
+        return self._file
+
+    @property
+    def columns(self):
+        with self._lock:
+            return self._open().schema_arrow.names
+
+    def get(self, columns):
+        '''
+        Return a dataframe with the given columns.
+        '''
+        columns = list(dict.fromkeys(columns))
+        with self._lock:
+            missing = [col for col in columns if col not in self.loaded]
+            if missing:
+                df = self._open().read(columns=missing).to_pandas()
+                self.loaded.update(df.items())
+            return pd.DataFrame({col: self.loaded[col] for col in columns})
+
+frame = LazyFrame(data_path, snapshot_path)
+
+def get_columns(*columns):
+    return frame.get(columns)
+
+def __getattr__(name):
+    # data.d is the whole dataframe, loaded on first use
+    if name == 'd':
+        return frame.get(frame.columns)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+@lru_cache(maxsize=None)
+def _read_stimuli():
+    # One row per GroupID with the stimulus text (written by merge-stimuli.py)
+    return pd.read_csv(stimuli_path, index_col='GroupID')
 
 def get_rowid_from_pointnumber(point_number):
-    return(d.iloc[point_number]['RowID'])
+    return(get_columns('RowID')['RowID'].iloc[point_number])
+
+@lru_cache(maxsize=None)
+def get_stimulus(group_id):
+    '''
+    Return a markdown string with the
+    context/answer conditions and the stimulus text
+    of the item group_id.
+    '''
+    s = _read_stimuli().loc[group_id]
+    out = f'GroupID: **{group_id}**\n\nAnswerCertainty: **`{s.AnswerCertainty}`**\n\nAnswerPolarity: **`{s.AnswerPolarity}`**\n\nContextType: **`{s.ContextType}`**\n\n'
+    out += f'{s.Context}\n\n{s.YourQuestionIntro} **{s.YourQuestion}**\n\n{s.AnswerIntro} **{s.Answer}**'
+    return out
 
 slider_responses = {
     'pri': 'Prior',
@@ -44,21 +113,33 @@ col_names = (
 ))
 
 # OPTIONS FOR SUMMARY STATS
-list_of_stats = [
-    'mean_rank',
-    'mean',
-    'min',
-    'q25',
-    'q50',
-    'q75',
-    'max',
-]
-
-stats = [
-    'Score',
-    'Rank',
-    'Rank Diff',
-    'Mean Score',
-    'Mean Rank',
-    'Mean Rank Diff',
-]
\ No newline at end of file
+# Group stats that add_stats_and_stimuli.py can add (its --stats), with their labels
+list_of_stats = {
+    'mean': 'Mean',
+    'min': 'Min',
+    'q25': 'Q25',
+    'q50': 'Median',
+    'q75': 'Q75',
+    'max': 'Max',
+}
+
+@lru_cache(maxsize=None)
+def get_stat_suffixes():
+    '''
+    Return a dict mapping the label of each statistic
+    to the suffix of its columns,
+    for the group stats that are in the data.
+    '''
+    columns = frame.columns
+    suffixes = {
+        'Score': '',
+        'Rank': '_rank',
+        'Rank Diff': '_rank_diff',
+    }
+    for stat, label in list_of_stats.items():
+        if f'pri_{stat}' not in columns:
+            continue
+        suffixes[f'{label} Score'] = f'_{stat}'
+        suffixes[f'{label} Rank'] = f'_rank_{stat}'
+        suffixes[f'{label} Rank Diff'] = f'_rank_diff_{stat}'
+    return suffixes
@@ -0,0 +1,33 @@
+import os
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Parquet snapshots of the csv files of the dashboard.
+# Importing this module reads no data, so the data scripts can use it before the csv files exist.
+
+def source_fingerprint(path):
+    '''
+    Size and modification time of path,
+    stored in the snapshot to tell whether it is still up to date.
+    '''
+    stat = os.stat(path)
+    return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+def build_snapshot(source, snapshot):
+    '''
+    Convert the csv file source to the Parquet file snapshot.
+    '''
+    table = pa.Table.from_pandas(pd.read_csv(source), preserve_index=False)
+    metadata = {**(table.schema.metadata or {}), b'source_fingerprint': source_fingerprint(source).encode()}
+    tmp = Path(snapshot).with_name(Path(snapshot).name + '.tmp')
+    pq.write_table(table.replace_schema_metadata(metadata), tmp)
+    # Replace the old snapshot at once, so that a running dashboard never reads a partial file
+    os.replace(tmp, snapshot)
+
+def snapshot_is_current(source, snapshot):
+    if not os.path.exists(snapshot):
+        return False
+    metadata = pq.read_schema(snapshot).metadata or {}
+    return metadata.get(b'source_fingerprint') == source_fingerprint(source).encode()
@@ -1,7 +1,9 @@
 import dash
 from dash import html, Input, Output, State, dcc
 from assets import components, styles, data
-import plotly.express as px
+from functools import lru_cache
+import numpy as np
+import plotly.graph_objects as go
 import json
 
 PLOT_TEMPLATE = 'plotly_dark'
@@ -21,15 +23,15 @@ menus = [{
         'value': 'rel',
     },{
         'id': 'x_stat',
-        'options': data.stats,
+        'options': list(data.get_stat_suffixes()),
         'value': 'Score',
     }, {
         'id': 'y_stat',
-        'options': data.stats,
+        'options': list(data.get_stat_suffixes()),
         'value': 'Score',
     }, {
         'id': 'color_stat',
-        'options': data.stats,
+        'options': list(data.get_stat_suffixes()),
         'value': 'Score',
     },
 ]
@@ -62,6 +64,8 @@ layout = html.Div(children=[
         ]),
         html.Div(style=dict(display='flex', marginBottom=0), children=[
         html.Div(style=dict(width='70%'), children=[dcc.Graph(id='myplot'),]),
+        # settings of the figure currently shown, to patch it instead of replacing it
+        dcc.Store(id='plotted_settings'),
         html.Div(style=dict(width='5%'), children=[]),
         html.Div(style=dict(width='25%'), children=[dcc.Markdown(id='hovertext')]),
     ]),
@@ -78,14 +82,7 @@ plot_settings_inputs = [
 )
 def update_plot_settings(x_col, y_col, color_col,
                          x_stat, y_stat, color_stat):
-    parse_stats = {
-        'Score': '',
-        'Rank': '_rank',
-        'Rank Diff': '_rank_diff',
-        'Mean Score': '_mean',
-        'Mean Rank': '_rank_mean',
-        'Mean Rank Diff': '_rank_diff_mean',
-    }
+    parse_stats = data.get_stat_suffixes()
     plot_settings = dict()
     plot_settings['x'] = x_col + parse_stats[x_stat]
     plot_settings['y'] = y_col + parse_stats[y_stat]
@@ -94,47 +91,113 @@ def update_plot_settings(x_col, y_col, color_col,
     plot_settings['highlight'] = 'None'
     return plot_settings
 
-@dash.callback(
-    Output('myplot', 'figure'),
-    [
-        State('plot_settings', 'data'),
-        Input('plot_settings', 'modified_timestamp'),
-    ],
-)
-def update_graph(plot_settings, timestamp):
-    if not plot_settings:
-        return
-    plotdf = data.d
+@lru_cache(maxsize=32)
+def scatter_data(x, y, color):
+    '''
+    Return the x, y and marker color arrays of the scatter plot.
+    '''
+    df = data.get_columns(x, y, color)
+    return df[x].to_numpy(), df[y].to_numpy(), df[color].to_numpy()
+
+@lru_cache(maxsize=32)
+def highlight_positions(highlight):
+    '''
+    Return the positions of the highlighted RowIDs in the data.
+    '''
+    if highlight == 'None':
+        return np.array([], dtype=int)
+    return np.flatnonzero(data.get_columns('RowID')['RowID'].isin(highlight))
+
+def hovertemplate(x, y, color):
+    return f'{x}=%{{x}}<br>{y}=%{{y}}<br>{color}=%{{marker.color}}<extra></extra>'
+
+def highlight_data(plot_settings):
+    xs, ys, cs = scatter_data(plot_settings['x'], plot_settings['y'], plot_settings['color'])
+    positions = highlight_positions(plot_settings['highlight'])
+    return xs[positions], ys[positions], cs[positions]
+
+def build_figure(plot_settings):
     x = plot_settings['x']
     y = plot_settings['y']
     color = plot_settings['color']
-    color_scale = plot_settings['color_scale']
-    highlight = plot_settings['highlight']
-    # Create figure
-    fig = px.scatter(plotdf, 
-        x=x, 
-        y=y, 
-        color=color, 
+    xs, ys, cs = scatter_data(x, y, color)
+    hx, hy, hc = highlight_data(plot_settings)
+    # WebGL traces stay responsive with hundreds of thousands of points.
+    # Both traces share the color axis, so a new color only needs new marker colors.
+    fig = go.Figure([
+        go.Scattergl(x=xs, y=ys, mode='markers',
+                     marker=dict(color=cs, coloraxis='coloraxis'),
+                     hovertemplate=hovertemplate(x, y, color)),
+        ## HIGHLIGHTING
+        # hover and selection refer to points of the first trace
+        go.Scattergl(x=hx, y=hy, mode='markers',
+                     marker=dict(color=hc, coloraxis='coloraxis', size=20),
+                     hoverinfo='skip'),
+    ])
+    fig.update_layout(
         template=PLOT_TEMPLATE,
-        color_continuous_scale=color_scale)
+        showlegend=False,
+        coloraxis=dict(colorscale=plot_settings['color_scale'], colorbar=dict(title=dict(text=color))),
+        yaxis=dict(title=dict(text=y)),
+    )
     ## TURN ON CLICK TO SELECT
     fig.update_layout(clickmode='event+select')
-
-    ## HIGHLIGHTING
-    if highlight != 'None':
-        q = f'RowID in @highlight'
-        fig.add_traces(
-            px.scatter(plotdf.query(q), 
-                    x=x, y=y, color=color)
-                    .update_traces(marker_size=20).data
-        )
     ## AXES AND MARGINS OPTIONS
     # put x axis label on top
-    fig.update_layout(xaxis=dict(title_standoff=5, side='top'),)
+    fig.update_layout(xaxis=dict(title=dict(text=x, standoff=5), side='top'),)
     # reduce margins
     fig.update_layout(margin=dict(l=20, r=20, t=20, b=5),)
     return fig
 
+def patch_figure(plot_settings, plotted_settings):
+    '''
+    Return a patch that changes the color and highlighting of the figure
+    plotted with plotted_settings, which has the same axes.
+    '''
+    fig = dash.Patch()
+    color = plot_settings['color']
+    if color != plotted_settings['color']:
+        _, _, cs = scatter_data(plot_settings['x'], plot_settings['y'], color)
+        fig['data'][0]['marker']['color'] = cs
+        fig['data'][0]['hovertemplate'] = hovertemplate(plot_settings['x'], plot_settings['y'], color)
+        fig['layout']['coloraxis']['colorbar']['title']['text'] = color
+    if plot_settings['color_scale'] != plotted_settings['color_scale']:
+        fig['layout']['coloraxis']['colorscale'] = plot_settings['color_scale']
+    if color != plotted_settings['color'] or plot_settings['highlight'] != plotted_settings['highlight']:
+        hx, hy, hc = highlight_data(plot_settings)
+        fig['data'][1]['x'] = hx
+        fig['data'][1]['y'] = hy
+        fig['data'][1]['marker']['color'] = hc
+    return fig
+
+@dash.callback(
+    [
+        Output('myplot', 'figure'),
+        Output('plotted_settings', 'data'),
+    ],
+    [
+        State('plot_settings', 'data'),
+        Input('plot_settings', 'modified_timestamp'),
+        State('plotted_settings', 'data'),
+    ],
+)
+def update_graph(plot_settings, timestamp, plotted_settings):
+    if not plot_settings:
+        return None, None
+    # highlight is a list of RowIDs (or 'None'), which has to be hashable for the cache
+    plot_settings = dict(plot_settings)
+    if plot_settings['highlight'] != 'None':
+        plot_settings['highlight'] = tuple(plot_settings['highlight'])
+    if plotted_settings and plotted_settings['highlight'] != 'None':
+        plotted_settings['highlight'] = tuple(plotted_settings['highlight'])
+    if plot_settings == plotted_settings:
+        return dash.no_update, dash.no_update
+    # Only a new x or y needs a new figure
+    if (plotted_settings and plot_settings['x'] == plotted_settings['x']
+            and plot_settings['y'] == plotted_settings['y']):
+        return patch_figure(plot_settings, plotted_settings), plot_settings
+    return build_figure(plot_settings), plot_settings
+
 # Update sidebar text when hovering on a point
 @dash.callback(
     Output('hovertext', 'children'),
@@ -146,7 +209,7 @@ def display_hover_data(hoverData):
     if hoverData is None:
         return ''
     point_index = hoverData['points'][0]['pointIndex']
-    hovertext = data.d.iloc[point_index]['stimulus']
+    hovertext = data.get_stimulus(data.get_columns('GroupID')['GroupID'].iloc[point_index])
     return hovertext
 
 # Update tag window on select
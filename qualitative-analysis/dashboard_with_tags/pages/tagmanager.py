@@ -56,7 +56,10 @@ def update_highlighted_tag(tag_menu_value):
     Input('item-menu', 'value'),
 )
 def display_current_item(item_menu_value):
-    stim_text = data.d.query('RowID == @item_menu_value').stimulus
+    group_ids = data.get_columns('RowID', 'GroupID').query('RowID == @item_menu_value').GroupID
+    if group_ids.empty:
+        return ''
+    stim_text = data.get_stimulus(group_ids.iloc[0])
     return stim_text
 
 
@@ -1,14 +1,32 @@
+import argparse
+import sys
 import numpy as np
 import pandas as pd
 from pathlib import Path
 
 relevance_dir = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(relevance_dir / 'analysis'))
+from schema import apply_schema
 # INPUT
 included_data_path = relevance_dir / 'qualitative-analysis' / 'data' / 'included_data.csv'
 
 # OUTPUT
 processed_data_path = relevance_dir / 'qualitative-analysis' / 'data' / 'processed_data.csv'
 
+# Group stats that can be added (the dashboard offers the ones in dashboard_with_tags/assets/data.list_of_stats):
+# groupby transform name and arguments
+GROUP_STATS = {
+    'mean': ('mean',),
+    'min': ('min',),
+    'q25': ('quantile', 0.25),
+    'q50': ('quantile', 0.5),
+    'q75': ('quantile', 0.75),
+    'max': ('max',),
+}
+parser = argparse.ArgumentParser()
+parser.add_argument("--stats", nargs="+", default=['mean'], choices=list(GROUP_STATS), help="Stats of each GroupID to add for every measure, its rank and its rank diff")
+args = parser.parse_args()
+
 # Augment dataframe with markdown-formatted stimulus text.
 def format_stimulus(s):
     '''
@@ -21,7 +39,7 @@ def format_stimulus(s):
     return out
 
 # Read the round 2 data with exclusions applied.
-d = pd.read_csv(included_data_path)
+d = apply_schema(pd.read_csv(included_data_path))
 
 ###############################
 ### DROP AND RENAME COLUMNS ###
@@ -31,6 +49,15 @@ dropped_cols = [
     'attention_score',
     'reasoning_score',
     'group',
+    # Measures the dashboard doesn't show
+    'kl',
+    'beta_kl',
+    'entropy_change_scaled',
+    'kl_scaled',
+    'beta_entropy_change_scaled',
+    'beta_kl_scaled',
+    'beta_bayes_factor_utility_1_scaled',
+    'pure_second_order_belief_change_scaled',
 ]
 
 submission_id = [
@@ -59,26 +86,15 @@ second_order_cols = [
     'second_order_belief_change',
     'beta_entropy_change',
     'beta_kl_utility',
-    'beta_bayes_factor_utility',
+    'beta_bayes_factor_utility_1',
     'pure_second_order_belief_change',
 ]
+# Beta params fitted for each metric (see analysis/beta_columns.py)
 beta_params = [
-    'prior_beta_for_kl_a',
-    'prior_beta_for_kl_b',
-    'posterior_beta_for_kl_a',
-    'posterior_beta_for_kl_b',
-    'prior_beta_for_entropy_a',
-    'prior_beta_for_entropy_b',
-    'posterior_beta_for_entropy_a',
-    'posterior_beta_for_entropy_b',
-    'prior_beta_for_bf_a',
-    'prior_beta_for_bf_b',
-    'posterior_beta_for_bf_a',
-    'posterior_beta_for_bf_b',
-    'prior_beta_for_2nd_order_change_a',
-    'prior_beta_for_2nd_order_change_b',
-    'posterior_beta_for_2nd_order_change_a',
-    'posterior_beta_for_2nd_order_change_b',
+    f'{p}_beta_for_{metric}_{ab}'
+    for metric in ['beta_kl', 'beta_entropy_change', 'beta_bayes_factor_utility_1', 'pure_second_order_belief_change', 'kl', 'entropy_change']
+    for p in ['prior', 'posterior']
+    for ab in ['a', 'b']
 ]
 
 # Check that the partition is exhaustive.
@@ -101,7 +117,7 @@ second_order_col_renames = {
     'second_order_belief_change'        : '2ord_bch',
     'beta_entropy_change'               : 'beta_ech',
     'beta_kl_utility'                   : 'beta_klu',
-    'beta_bayes_factor_utility'         : 'beta_bfu',
+    'beta_bayes_factor_utility_1'       : 'beta_bfu',
     'pure_second_order_belief_change'   : 'beta_bch',
 }
 
@@ -118,8 +134,8 @@ d = (d
 
 # Add unique row ids and non-unique group ids for convenience
 d = d.assign(
-    RowID = lambda x: x.StimID.astype(str) + x.AnswerCertainty + x.AnswerPolarity + x.ContextType + x.submission_id.astype(str),
-    GroupID = lambda x: x.StimID.astype(str) + x.AnswerCertainty + x.AnswerPolarity + x.ContextType
+    RowID = lambda x: x.StimID.astype(str) + x.AnswerCertainty.astype(str) + x.AnswerPolarity.astype(str) + x.ContextType.astype(str) + x.submission_id.astype(str),
+    GroupID = lambda x: x.StimID.astype(str) + x.AnswerCertainty.astype(str) + x.AnswerPolarity.astype(str) + x.ContextType.astype(str)
 )
 
 # Treat categorical columns as categorical.
@@ -128,9 +144,6 @@ d = d.astype(
     'RowID': 'category',
     'GroupID': 'category',
     'StimID': 'category',
-    'AnswerCertainty': 'category',
-    'AnswerPolarity': 'category',
-    'ContextType': 'category',
     }
 )
 
@@ -140,45 +153,23 @@ d = d.astype(
 
 new_col_names = list(first_order_col_renames.values()) + list(second_order_col_renames.values())
 
-## Add ranks
-for col in new_col_names:
-    d[f'{col}_rank'] = d[col].rank()
-
-## Add rank diffs
-for col in new_col_names:
-    d[f'{col}_rank_diff'] = d[f'{col}_rank'] - d['rel_rank']
-
-## Functions for getting aggregate stats.
-def combine_dicts(list_of_dicts):
-    '''
-    Helper function to flatten a list of dicts.
-    (For some reason itertools.chain.from_iterable
-    was not working for this use case.)
-    '''
-    single_dict = {}
-    for d in list_of_dicts:
-       single_dict.update(d)
-    return single_dict
-
-def summary_stats(grp: pd.DataFrame) -> pd.Series:
-    '''
-    Calcuate summary stats for each measure.
-    '''
-    return pd.Series(combine_dicts([
-        # list comprehension of dicts where
-        # each dict contains summary stats
-        # for one input column
-        {
-            f'{col}_mean': grp[col].mean(),
-            f'{col}_rank_mean': grp[col+'_rank'].mean(),
-            f'{col}_rank_diff_mean': grp[col+'_rank_diff'].mean(),
-        } for col in new_col_names
-    ]))
-
-
-
-group_stats = d.groupby('GroupID').apply(summary_stats)
-
-d = pd.merge(d, group_stats, on='GroupID')
-
-d.to_csv(processed_data_path, index=False)
\ No newline at end of file
+# Ranks of every measure over all rows, and their difference to the rank of the relevance judgment
+ranks = d[new_col_names].rank()
+rank_diffs = ranks.sub(ranks['rel'], axis=0)
+d = pd.concat([d, ranks.add_suffix('_rank'), rank_diffs.add_suffix('_rank_diff')], axis=1)
+
+## Aggregate stats of each GroupID, broadcast to its rows.
+# Each measure, its rank and its rank diff get a `_<stat>` column for every stat in --stats,
+# e.g. `klu_mean`, `klu_rank_mean` and `klu_rank_diff_mean`.
+stat_cols = [f'{col}{suffix}' for col in new_col_names for suffix in ['', '_rank', '_rank_diff']]
+by_group = d.groupby('GroupID', observed=True)[stat_cols]
+group_stats = []
+for stat in args.stats:
+    how, *how_args = GROUP_STATS[stat]
+    group_stats.append(by_group.transform(how, *how_args).add_suffix(f'_{stat}'))
+# Keep the stats of each column together, in the order of --stats
+group_stats = pd.concat(group_stats, axis=1)
+group_stats = group_stats[[f'{col}_{stat}' for col in stat_cols for stat in args.stats]]
+d = pd.concat([d, group_stats], axis=1)
+
+d.to_csv(processed_data_path, index=False)
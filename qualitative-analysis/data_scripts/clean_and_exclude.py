@@ -1,94 +1,83 @@
+import argparse
 import numpy as np
 import pandas as pd
 import os
+import sys
 from pathlib import Path
 
 # Set filepaths.
 relevance_dir = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(relevance_dir / 'analysis'))
+from schema import apply_schema
 
 round2_results_path = relevance_dir / 'results' / 'round_2.0' / 'results_preprocessed.csv'
 data_with_exclusions_path = relevance_dir / 'qualitative-analysis' / 'data' / 'included_data.csv'
 excluded_data = relevance_dir / 'qualitative-analysis' / 'data' / 'excluded_data.csv'
 
+# Exclusion thresholds.
+parser = argparse.ArgumentParser()
+parser.add_argument("--min_belief_change", type=float, default=0.05, help="Answers (other than non-answers) that change the probability by less than this, and don't change the confidence, are deviant")
+parser.add_argument("--min_task_sensitivity", type=float, default=0.75, help="Include participants whose fraction of non-deviant answers is above this")
+parser.add_argument("--min_attention_score", type=float, default=1, help="Include participants whose attention score is at least this")
+parser.add_argument("--min_reasoning_score", type=float, default=0.5, help="Include participants whose reasoning score is above this")
+args = parser.parse_args()
+
 # Read the round 2 data.
-d = pd.read_csv(round2_results_path)
+# The schema treats categorical columns as categorical.
+d = apply_schema(pd.read_csv(round2_results_path))
 
 ## CLEANING
 
 # All non-answers are set to positive polarity
 # as in Michael's script.
-d['AnswerPolarity'] = np.where(
-    d['AnswerCertainty'] == 'non_answer',
-    'positive',
-    d['AnswerPolarity'])
-
-# Treat categorical columns as categorical.
-d = d.astype(
-    { 
-    'StimID': 'category',
-    'AnswerCertainty': 'category',
-    'AnswerPolarity': 'category',
-    'ContextType': 'category',
-    }
-)
+d['AnswerPolarity'] = d['AnswerPolarity'].where(
+    d['AnswerCertainty'] != 'non_answer',
+    'positive')
 
 ## EXCLUSIONS
 
-# If not a non-answer, mark participants 
+# If not a non-answer, mark participants
 # with < 0.05 belief change as deviant.
 
-d['answer_class'] = np.where(
-    d['AnswerCertainty'] != 'non_answer',
-    True,
-    False
-)
+d['answer_class'] = d['AnswerCertainty'] != 'non_answer'
 
-d['belief_change'] = np.where(
-    ((np.abs(d['prior_sliderResponse'] - d['posterior_sliderResponse']) >= 0.05) 
-        | d['prior_confidence'] != d['posterior_confidence']),
-    True,
-    False
+d['belief_change'] = (
+    (np.abs(d['prior_sliderResponse'] - d['posterior_sliderResponse']) >= args.min_belief_change)
+    | (d['prior_confidence'] != d['posterior_confidence'])
 )
 
-d['deviant'] = np.where(
-    d['answer_class'],
-    ~d['belief_change'],
-    False
-)
+d['deviant'] = d['answer_class'] & ~d['belief_change']
 
 # Compute task-sensitivity.
-d = (
-d.groupby(['submission_id'])
-    .apply(lambda g: g.assign(
-        task_sensitivity = (1 - (g.deviant.sum() /g.answer_class.sum()))))
-)
+# Rows of a participant are kept together, as in earlier versions of this script.
+d = d.sort_values('submission_id', kind='stable')
+by_participant = d.groupby('submission_id')
+d['task_sensitivity'] = 1 - by_participant['deviant'].transform('sum') / by_participant['answer_class'].transform('sum')
 
-# Apply exclusion criteria by filtering on a query.
-
-exclusion_query = '(attention_score == 1 & reasoning_score > 0.5 & task_sensitivity > 0.75)'
-included = (
-    d
-    .query(exclusion_query)
-    .drop([ 
-        'answer_class', 
-        'belief_change', 
-        'deviant',
-        'task_sensitivity',
-        'Unnamed: 0',
-    ], axis=1)
-)
-excluded = (
-    d
-    .query('~' + exclusion_query)
-    .drop([ 
-        # 'answer_class', 
-        # 'belief_change', 
-        # 'deviant',
-        # 'task_sensitivity',
-        'Unnamed: 0',
-    ], axis=1)
-)
+# Apply exclusion criteria: every rule is a mask, participants are included if they pass all of them.
+rules = {
+    'attention': d['attention_score'] >= args.min_attention_score,
+    'reasoning': d['reasoning_score'] > args.min_reasoning_score,
+    'task_sensitivity': d['task_sensitivity'] > args.min_task_sensitivity,
+}
+include = np.logical_and.reduce(list(rules.values()))
+
+# Participants can fail several rules, so the counts don't add up to the total.
+for rule, passed in rules.items():
+    print(f"Excluded by {rule}: {d.loc[~passed, 'submission_id'].nunique()} participants")
+print(f"Excluded: {d.loc[~include, 'submission_id'].nunique()} of {d['submission_id'].nunique()} participants")
+
+included = d[include].drop([
+    'answer_class',
+    'belief_change',
+    'deviant',
+    'task_sensitivity',
+    'Unnamed: 0',
+], axis=1)
+excluded = d[~include].drop([
+    'Unnamed: 0',
+], axis=1)
 
 # Write to file.
 included.to_csv(data_with_exclusions_path, index=False)
-excluded.to_csv(excluded_data, index=False)
\ No newline at end of file
+excluded.to_csv(excluded_data, index=False)
@@ -1,17 +1,24 @@
+import sys
 import numpy as np
 import pandas as pd
 from pathlib import Path
 
 relevance_dir = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(relevance_dir / 'analysis'))
+sys.path.insert(0, str(relevance_dir / 'qualitative-analysis' / 'dashboard_with_tags'))
+from schema import apply_schema
+from assets.snapshot import build_snapshot
 # INPUT
 processed_data_path = relevance_dir / 'qualitative-analysis' / 'data' / 'processed_data.csv'
-relevance_stimuli_path = relevance_dir / 'trials' / 'relevance_stimuli.csv'
+relevance_stimuli_path = relevance_dir / 'experiment' / 'trials' / 'relevance_stimuli.csv'
 # OUTPUT
-processed_data_with_stimuli_path = relevance_dir / 'qualitative-analysis' / 'data' / 'processed_data_with_stimuli.csv'
+processed_data_dashboard_path = relevance_dir / 'qualitative-analysis' / 'data' / 'processed_data_dashboard.csv'
+stimuli_path = relevance_dir / 'qualitative-analysis' / 'data' / 'stimuli.csv'
+processed_data_snapshot_path = relevance_dir / 'qualitative-analysis' / 'data' / 'processed_data_dashboard.parquet'
 
 # Add in stimuli
 
-st = pd.read_csv(relevance_stimuli_path)
+st = apply_schema(pd.read_csv(relevance_stimuli_path))
 st = (st
     .query('TaskType == "relevance"')
 )
@@ -23,41 +30,34 @@ st['AnswerPolarity'] = np.where(
 
 # Next step: merge in stimuli
 
-d = pd.read_csv(processed_data_path)
+d = apply_schema(pd.read_csv(processed_data_path))
+
+# The stimulus text is the same for every response to an item,
+# so it is stored once per GroupID in a separate table
+# and rendered by the dashboard when it is displayed
+# (join stimuli.csv on GroupID to get it next to the responses).
+stimulus_cols = [
+    'Context',
+    'YourQuestionIntro',
+    'YourQuestion',
+    'AnswerIntro',
+    'Answer',
+    'CriticalProposition',
+]
+group_keys = ['StimID', 'AnswerCertainty', 'AnswerPolarity', 'ContextType']
 
-dst = d.merge(st,
+stimuli = (d[['GroupID'] + group_keys]
+    .drop_duplicates('GroupID')
+    .merge(st[group_keys + stimulus_cols],
             how='left')
-
-# Augment dataframe with markdown-formatted stimulus text.
-def format_stimulus(s):
-    '''
-    Take a row s in the dataframe and 
-    return a markdown string with the 
-    context/answer conditions and the stimulus text.
-    '''
-    out = f'GroupID: **{s.GroupID}**\n\nAnswerCertainty: **`{s.AnswerCertainty}`**\n\nAnswerPolarity: **`{s.AnswerPolarity}`**\n\nContextType: **`{s.ContextType}`**\n\n'
-    out += f'{s.Context}\n\n{s.YourQuestionIntro} **{s.YourQuestion}**\n\n{s.AnswerIntro} **{s.Answer}**'
-    return out
-
-dst['stimulus'] = dst.apply(
-    lambda s: format_stimulus(s),
-    axis=1)
-
-
-drop_before_write = [
-    'TrialType',
-    'TaskType',    
-    'name',
-    'SliderLabelLeft',
-    'SliderLabelRight',
-    'TaskQuestion',
-]
+)
 
 # write to csv
 
-(dst
-    .drop(drop_before_write, axis=1)
-    .to_csv(processed_data_with_stimuli_path, index=False, 
+d.to_csv(processed_data_dashboard_path, index=False,
         float_format='%.2f'
     )
-)
\ No newline at end of file
+stimuli.to_csv(stimuli_path, index=False)
+
+# Typed snapshot the dashboard loads column by column
+build_snapshot(processed_data_dashboard_path, processed_data_snapshot_path)